@@ -0,0 +1,386 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from synclib.encryption import (
+    KEYSTREAM_CACHE,
+    EncryptionKey,
+    decryptBytes,
+    encryptBytes,
+    loadNumpy,
+)
+import synclib.config as config
+import synclib.delta as delta
+
+"""
+Offline benchmarks of cipher, in-process request handling and
+end-to-end sync over loopback, results are written as JSON:
+
+{"environment": {...}, "results": {name: {"value", "unit", "better"}}}
+
+and compared with baseline file given with --baseline, metric
+which got worse by more than --tolerance is reported as regression
+and makes the script exit with status 1
+"""
+
+# seed of generated payloads, runs have to be comparable
+SEED = 1
+
+
+def payload(size: int, seed: int = SEED) -> bytes:
+    """Deterministic pseudo random payload of given size"""
+    return random.Random(seed).randbytes(size)
+
+
+def timings(func, repeat: int, number: int = 1) -> list:
+    """Call func number times in each of repeat rounds
+
+    Returns:
+        list: seconds per single call, one value per round
+    """
+    output = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        output.append((time.perf_counter() - start) / number)
+    return output
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest-rank percentile of values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Results(dict):
+    """Benchmark results by metric name"""
+
+    def add(self, name: str, value: float, unit: str, better: str = "lower") -> None:
+        """Record metric
+
+        Args:
+            name (str): unique metric name
+            value (float): measured value
+            unit (str): unit of value
+            better (str, optional): "lower" or "higher". Defaults to "lower".
+        """
+        self[name] = {"value": round(value, 6), "unit": unit, "better": better}
+        print(f"{name:<48} {value:>14.3f} {unit}", file=sys.stderr)
+
+    def latencies(self, name: str, values: list) -> None:
+        """Record p50, p90 and p99 of latencies given in seconds"""
+        for label, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            self.add(f"{name}.{label}", percentile(values, fraction) * 1000, "ms")
+
+
+def benchCipher(results: Results, quick: bool) -> None:
+    """Throughput of encryptBytes() and decryptBytes()"""
+    key = "benchmark-key-0123456789"
+    sizes = (1024, 65536, 1048576) if quick else (1024, 65536, 1048576, 16777216)
+    for size in sizes:
+        data = payload(size)
+        encrypted = encryptBytes(data, key)
+        number = max(1, 4194304 // size)
+        repeat = 3 if quick else 7
+        for name, func, argument in (
+            ("encrypt", encryptBytes, data),
+            ("decrypt", decryptBytes, encrypted),
+        ):
+            best = min(timings(lambda: func(argument, key), repeat, number))
+            results.add(f"cipher.{name}.{size}", size / best / 1048576, "MiB/s", "higher")
+
+
+def benchKeys(results: Results, quick: bool) -> None:
+    """Cost of deriving EncryptionKey and its Keystream
+    (what every KEYSTREAM_CACHE miss pays)"""
+    for length in (16, 64, 1024):
+        key = EncryptionKey.getNewKey(length)
+        repeat = 5 if quick else 20
+        best = min(timings(lambda: EncryptionKey(key), repeat, 20))
+        results.add(f"keys.derive.{length}", best * 1e6, "us")
+
+        def miss():
+            KEYSTREAM_CACHE.clear()
+            KEYSTREAM_CACHE.get(key)
+
+        best = min(timings(miss, repeat, 20))
+        results.add(f"keys.keystream.{length}", best * 1e6, "us")
+    KEYSTREAM_CACHE.clear()
+
+
+class Response:
+    """start_response collecting status and headers"""
+
+    def __call__(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = dict(headers)
+
+
+def callApp(app, method: str, path: str, headers: dict = None, body: bytes = b""):
+    """Run WSGI application in-process, body is consumed
+
+    Returns:
+        tuple: status, headers and body of response
+    """
+    path, _, query = path.partition("?")
+    env = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body),
+    }
+    for name, value in (headers or {}).items():
+        env["HTTP_" + name.upper().replace("-", "_")] = value
+    response = Response()
+    output = app(env, response)
+    data = b"".join(bytes(chunk) for chunk in output)
+    if hasattr(output, "close"):
+        output.close()
+    return response.status, response.headers, data
+
+
+def writeConfig(path: str, **values) -> None:
+    """Write server config file, missing values are defaults"""
+    with open(path, "w") as file:
+        json.dump(values, file)
+
+
+def benchWsgi(results: Results, workdir: str, quick: bool) -> None:
+    """Latency percentiles of server.main per endpoint,
+    called in-process without network"""
+    import server
+
+    target = os.path.join(workdir, "served.bin")
+    tree = os.path.join(workdir, "tree")
+    data = payload(1048576)
+    with open(target, "wb") as file:
+        file.write(data)
+    for index in range(32):
+        os.makedirs(os.path.join(tree, str(index % 4)), exist_ok=True)
+        with open(os.path.join(tree, str(index % 4), f"{index}.bin"), "wb") as file:
+            file.write(payload(16384, index))
+    path = os.path.join(workdir, "server.cfg")
+    cache = config.CachedCFG(config.ServerCFG, path)
+    previous, server.CONFIG = server.CONFIG, cache
+    key = "benchmark-key-0123456789"
+    repeat = 50 if quick else 300
+    try:
+        for encode in (False, True):
+            label = "encoded" if encode else "plain"
+            writeConfig(path, target=target, encode=encode, encode_key=key, allow_edit=True)
+            cache.invalidate()
+            tag = callApp(server.main, "GET", "/getFile")[1]["ETag"]
+            signature = delta.makeSignature(data[:-4096] + payload(4096, 2))
+            if encode:
+                signature = encryptBytes(signature, key)
+            cases = {
+                "connect": ("GET", "/connect", {}, b""),
+                "getFile": ("GET", "/getFile", {}, b""),
+                "getFile.zlib": ("GET", "/getFile", {"X-Accept-Compression": "zlib"}, b""),
+                "getFile.304": ("GET", "/getFile", {"If-None-Match": tag}, b""),
+                "getFile.range": ("GET", "/getFile", {"Range": "bytes=1000-66535"}, b""),
+                "watch.timeout0": ("GET", "/watch?timeout=0", {"If-None-Match": tag}, b""),
+                "getDelta": ("POST", "/getDelta", {}, signature),
+            }
+            for name, (method, url, headers, body) in cases.items():
+                values = timings(lambda: callApp(server.main, method, url, headers, body), repeat)
+                results.latencies(f"wsgi.{label}.{name}", values)
+            writeConfig(path, target=tree, encode=encode, encode_key=key)
+            cache.invalidate()
+            listing = json.dumps({"files": [f"{i % 4}/{i}.bin" for i in range(32)]})
+            listing = listing.encode("utf-8")
+            if encode:
+                listing = encryptBytes(listing, key)
+            values = timings(lambda: callApp(server.main, "GET", "/manifest"), repeat)
+            results.latencies(f"wsgi.{label}.manifest", values)
+            values = timings(lambda: callApp(server.main, "POST", "/getFiles", {}, listing), repeat)
+            results.latencies(f"wsgi.{label}.getFiles", values)
+    finally:
+        server.CONFIG = previous
+
+
+def benchSync(results: Results, workdir: str, quick: bool, backend: str) -> None:
+    """Headless end-to-end pull from local server over loopback"""
+    import server
+    import synclib.engine as engine
+    from synclib.stats import TransferStats
+    from synclib.connection import Connection
+
+    target = os.path.join(workdir, "remote.bin")
+    local = os.path.join(workdir, "local.bin")
+    size = 4194304 if quick else 33554432
+    data = bytearray(payload(size))
+    with open(target, "wb") as file:
+        file.write(data)
+    path = os.path.join(workdir, "server.cfg")
+    key = "benchmark-key-0123456789"
+    writeConfig(path, target=target, encode=True, encode_key=key)
+    cache = config.CachedCFG(config.ServerCFG, path)
+    previous, server.CONFIG = server.CONFIG, cache
+    host, port = "127.0.0.1", freePort()
+    stop = startServer(backend, server, host, port)
+    setup = {
+        "target": local,
+        "encode": True,
+        "encode_key": key,
+        "delta": True,
+        "compression": False,
+        "chunk_size": 65536,
+        "fsync": False,
+        "history": "",
+    }
+    pull = engine.pullFile.getTasks()[0]
+    try:
+        with Connection(host, str(port)) as connection:
+            repeat = 3 if quick else 5
+
+            def full():
+                engine.pullState.update(etag=None, signature=None, partial=None)
+                if os.path.exists(local):
+                    os.remove(local)
+                pull(TransferStats(), setup, connection)
+
+            best = min(timings(full, repeat))
+            results.add("sync.full", size / best / 1048576, "MiB/s", "higher")
+            values = timings(lambda: pull(TransferStats(), setup, connection), repeat * 10)
+            results.latencies("sync.unchanged", values)
+
+            def change():
+                # flip few bytes in the middle, pulled as delta
+                index = random.randrange(size)
+                data[index] ^= 0xFF
+                with open(target, "r+b") as file:
+                    file.seek(index)
+                    file.write(data[index : index + 1])
+                pull(TransferStats(), setup, connection)
+
+            values = timings(change, repeat)
+            results.latencies("sync.delta", values)
+            with open(local, "rb") as file:
+                if file.read() != data:
+                    raise RuntimeError("Pulled file differs from served one.")
+    finally:
+        stop()
+        server.CONFIG = previous
+
+
+def freePort() -> int:
+    """Find free TCP port on loopback"""
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def startServer(backend: str, server, host: str, port: int):
+    """Start server.main on background thread
+
+    Returns:
+        callable: function stopping the server
+    """
+    if backend == "asyncio":
+        import asyncio
+        import synclib.aioserver as aioserver
+
+        loop = asyncio.new_event_loop()
+        app = aioserver.AsyncWSGIServer(server.main, handlers={("GET", "/watch"): server.watch})
+        task = loop.create_task(app.serve(host, port))
+        thread = threading.Thread(target=loop.run_until_complete, args=(task,), daemon=True)
+        thread.start()
+        time.sleep(0.2)
+        return lambda: loop.call_soon_threadsafe(task.cancel)
+    import waitress
+
+    instance = waitress.create_server(server.main, host=host, port=port)
+    threading.Thread(target=instance.run, daemon=True).start()
+    time.sleep(0.2)
+    return instance.close
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Find metrics worse than baseline by more than tolerance
+
+    Args:
+        results (dict): current results
+        baseline (dict): stored results
+        tolerance (float): allowed relative change
+
+    Returns:
+        list: (name, baseline value, current value, relative change)
+    """
+    regressions = []
+    for name, current in results.items():
+        stored = baseline.get(name)
+        if stored is None or not stored["value"]:
+            continue
+        change = (current["value"] - stored["value"]) / stored["value"]
+        if current["better"] == "higher":
+            change = -change
+        if change > tolerance:
+            regressions.append((name, stored["value"], current["value"], change))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run synclib benchmarks.")
+    parser.add_argument(
+        "--only",
+        action="append",
+        choices=("cipher", "keys", "wsgi", "sync"),
+        help="run only selected group, can be repeated",
+    )
+    parser.add_argument("--quick", action="store_true", help="smaller payloads, fewer rounds")
+    parser.add_argument("--server", choices=("waitress", "asyncio"), default="waitress")
+    parser.add_argument("--output", help="write results JSON to file instead of stdout")
+    parser.add_argument("--baseline", help="results JSON to compare with")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="allowed relative regression"
+    )
+    args = parser.parse_args()
+    groups = args.only or ("cipher", "keys", "wsgi", "sync")
+    results = Results()
+    workdir = tempfile.mkdtemp(prefix="synclib-bench-")
+    try:
+        if "cipher" in groups:
+            benchCipher(results, args.quick)
+        if "keys" in groups:
+            benchKeys(results, args.quick)
+        if "wsgi" in groups:
+            benchWsgi(results, workdir, args.quick)
+        if "sync" in groups:
+            benchSync(results, workdir, args.quick, args.server)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": loadNumpy().__version__ if loadNumpy() is not None else None,
+            "server": args.server,
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent="    ", sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent="    ", sort_keys=True)
+        print()
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)["results"], args.tolerance)
+        for name, stored, current, change in regressions:
+            print(f"REGRESSION {name}: {stored} -> {current} ({change:+.1%})", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
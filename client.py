@@ -1,26 +1,24 @@
 import requests
 import json
-import time
 import tkinter as tk
 import tkinter.filedialog as tkfdl
 import tkinter.messagebox as tkmsb
 import tkinter.ttk as ttk
-from synclib.encryption import EncryptionKey, decrypt
 import synclib.config as config
-from synclib.daemon import Daemon
-
-
-@Daemon(delay=0.5)
-def pullFile(var, setup):
-    fileData = requests.get(
-        f"http://{setup['address']}{':'+setup['port'] if setup['port'] else ''}/getFile"
-    ).content
-    var.set(var.get() + len(fileData))
-    # throws requests.exceptions.ConnectionError !!!
-    if setup["encode"]:
-        fileData = b"".join(decrypt(fileData, setup["encode_key"]))
-    with open(setup["target"], "wb") as file:
-        file.write(fileData)
+import synclib.compression as compression
+from synclib.connection import Connection
+from synclib.stats import TransferStats
+from synclib.engine import (
+    FatalResponseCode,
+    UnwantedConnectionError,
+    handshake,
+    preparePulling,
+    pullerFor,
+    pullFile,
+    pullTree,
+    pushFile,
+    watchFile,
+)
 
 
 class Widget:
@@ -44,26 +42,27 @@ class wFrame(tk.Frame, Widget):
     pass
 
 
-class FatalResponseCode(Exception):
-    def __init__(self, code):
-        self.code = code
-
-
-class UnwantedConnectionError(Exception):
-    pass
-
-
 class ConnectionWindow(tk.Toplevel, Widget):
 
     entryWidgets: dict = None
     setup: dict = None
     innerFrame: tk.Frame = None
     performPulling = False
+    # daemon was told to stop and its pass (often pending long
+    # poll) hasn't returned yet, closing ends connection after it
+    stoppingPulling = False
+    closing = False
     labelWidgets = None
     uploadedDataVar = None
-    downloadedDataVar = None
     downloadLabelVar = None
+    statusLabelVar = None
     pollingRateVar = None
+    intervalLabelVar = None
+    connection: Connection = None
+    stats: TransferStats = None
+    _refreshJob = None
+    # ms between samples of transfer stats shown in labels
+    REFRESH_INTERVAL = 250
 
     def __init__(self, master: tk.Widget, setup: dict):
         """Connection top level window with polling control
@@ -76,11 +75,13 @@ class ConnectionWindow(tk.Toplevel, Widget):
         # set configuration variables
         self.pollingRateVar = tk.IntVar(value=500)
         self.uploadedDataVar = tk.IntVar(value=0)
-        self.downloadedDataVar = tk.IntVar(value=0)
         self.downloadLabelVar = tk.StringVar()
+        self.statusLabelVar = tk.StringVar(value="Status: OK")
+        self.intervalLabelVar = tk.StringVar()
         # add tracebacks to them
-        self.downloadedDataVar.trace("w", self.updateDownloadLabel)
         self.pollingRateVar.trace("w", self.updatePollingRate)
+        # updated by pulling daemons, sampled by refreshLabels()
+        self.stats = TransferStats()
         # clone reference to setup
         self.setup = setup
         # set main widget of this window
@@ -99,33 +100,27 @@ class ConnectionWindow(tk.Toplevel, Widget):
         # add widgets of this window
         self._insertWidgets()
         self._insertBindings()
+        # keep-alive session shared by handshake and pulling
+        self.connection = Connection(
+            self.setup["address"],
+            self.setup["port"],
+            self.master.config["pool_size"],
+            self.master.config["timeout"],
+            {"X-Accept-Compression": ", ".join(compression.METHODS)}
+            if self.master.config["compression"]
+            else None,
+        )
         # initialize connection
         if not self.__init_connection__():
+            self.connection.close()
             self.destroy()
             return None
-
-    def getData(self, url: str):
-        """Send get request to server defined
-        by setup provided to constructor
-
-        Args:
-            url (str): url path to resource
-
-        Raises:
-            FatalResponseCode: If status code of request
-                                is not equal 200
-
-        Returns:
-            bytes: bytes of response content
-        """
-        response = requests.get(
-            f"http://{self.setup['address']}{':'+self.setup['port'] if self.setup['port'] else ''}{url}"
-        )
-        if response.status_code != 200:
-            raise FatalResponseCode(response.status_code)
-        response = response.content
-        self.downloadedDataVar.set(self.downloadedDataVar.get() + len(response))
-        return response
+        if self.master.config["allow_edit"]:
+            self.entryWidgets["pushFile"]["state"] = "normal"
+        # fixed interval isn't used in adaptive mode
+        if self.master.config["adaptive"]:
+            self.entryWidgets["polling_rate"]["state"] = "disabled"
+        self.refreshLabels()
 
     def __init_connection__(self):
         """Initial test of connection with server
@@ -137,15 +132,8 @@ class ConnectionWindow(tk.Toplevel, Widget):
             bool: True if was succesfull, False otherwise
         """
         try:
-            response = self.getData("/connect")
-            if self.setup["encode"]:
-                response = json.loads(
-                    b"".join(decrypt(response, self.setup["encode_key"])).decode(
-                        "utf-8"
-                    )
-                )
-                if not response["success"]:
-                    raise UnwantedConnectionError()
+            response = handshake(self.stats, self.setup, self.connection)
+            if "allow_edit" in response:
                 self.master.config["allow_edit"] = response["allow_edit"]
             return True
         except (json.JSONDecodeError, UnicodeDecodeError):
@@ -173,8 +161,24 @@ class ConnectionWindow(tk.Toplevel, Widget):
             )
             return False
 
-    def updateDownloadLabel(self, *args, **kwargs):
-        val = self.downloadedDataVar.get()
+    def refreshLabels(self):
+        """Sample transfer stats and polling interval, daemons
+        change them from their threads so labels are refreshed
+        on fixed cadence instead of on every change
+        """
+        sample = self.stats.snapshot()
+        self.updateDownloadLabel(sample)
+        self.updateStatusLabel(sample)
+        self.updateIntervalLabel()
+        if self.stoppingPulling and not self.puller.isAlive():
+            if self.pullingStopped():
+                return None
+        elif self.performPulling and not self.puller.isAlive():
+            self.pullingFailed()
+        self._refreshJob = self.after(self.REFRESH_INTERVAL, self.refreshLabels)
+
+    def updateDownloadLabel(self, sample: dict):
+        val = sample["bytes"]
         if val < 1024:
             val = f"Pulled: {val} B"
         elif val < 1048576:
@@ -183,10 +187,40 @@ class ConnectionWindow(tk.Toplevel, Widget):
             val = f"Pulled: {val/1048576:.2f} MiB"
         else:
             val = f"Pulled: {val/1099511627776:.2f} GiB"
-        self.downloadLabelVar.set(val)
+        if val != self.downloadLabelVar.get():
+            self.downloadLabelVar.set(val)
+
+    def updateStatusLabel(self, sample: dict):
+        if sample["errors"]:
+            text = f"Status: {sample['errors']} of {sample['requests']} failed"
+        else:
+            text = f"Status: OK, {sample['requests']} requests"
+        if sample["latency"] is not None:
+            text += f", {sample['latency'] * 1000:.0f} ms"
+        if text != self.statusLabelVar.get():
+            self.statusLabelVar.set(text)
 
     def updatePollingRate(self, *args):
         pullFile.delay = self.pollingRateVar.get() / 1000
+        pullTree.delay = pullFile.delay
+
+    def updateIntervalLabel(self):
+        """Show effective polling interval"""
+        daemon = self.puller
+        backoff = daemon.backoff
+        if daemon is watchFile and daemon.interval == 0:
+            text = "Interval: long poll"
+        else:
+            text = f"Interval: {daemon.interval * 1000:.0f} ms"
+        if backoff is not None and backoff.failures:
+            text += f" (retry {backoff.failures})"
+        if text != self.intervalLabelVar.get():
+            self.intervalLabelVar.set(text)
+
+    @property
+    def puller(self):
+        """Daemon used for pulling, see pullerFor()"""
+        return pullerFor(self.master.config)
 
     def _insertBindings(self):
         self.protocol("WM_DELETE_WINDOW", self.endConnection)
@@ -207,7 +241,7 @@ class ConnectionWindow(tk.Toplevel, Widget):
             ),
             "status_info": self.innerFrame.gridIn(
                 tk.Label,
-                {"text": f"Status: OK", "width": 25},
+                {"width": 25, "textvariable": self.statusLabelVar},
                 {
                     "row": 1,
                     "column": 1,
@@ -232,6 +266,15 @@ class ConnectionWindow(tk.Toplevel, Widget):
                     "sticky": "s",
                 },
             ),
+            "interval_info": self.innerFrame.gridIn(
+                tk.Label,
+                {"width": 25, "textvariable": self.intervalLabelVar},
+                {
+                    "row": 4,
+                    "column": 1,
+                    "sticky": "s",
+                },
+            ),
         }
         self.entryWidgets = {
             "startPulling": self.innerFrame.gridIn(
@@ -265,38 +308,106 @@ class ConnectionWindow(tk.Toplevel, Widget):
                 },
                 {"row": 3, "column": 1},
             ),
+            "pushFile": self.innerFrame.gridIn(
+                tk.Button,
+                {
+                    "text": "Push File",
+                    "command": self.uploadFile,
+                    "width": 15,
+                    "state": "disabled",
+                },
+                {"row": 4, "column": 0},
+            ),
         }
-        self.updateDownloadLabel()
+        self.updateDownloadLabel(self.stats.snapshot())
 
     def startPulling(self, *args):
         """Initializes pullFile daemon, sets performPulling flag to true"""
         self.performPulling = True
         self.entryWidgets["startPulling"]["state"] = "disabled"
         self.entryWidgets["stopPulling"]["state"] = "normal"
-        pullFile(self.downloadedDataVar, self.master.config)
+        puller = preparePulling(self.master.config)
+        puller(self.stats, self.master.config, self.connection)
 
     def stopPulling(self, *args):
-        """Terminates pullFile daemon, sets performPulling flag to false"""
+        """Tells pulling daemon to terminate, without waiting for
+        its pass (pending /watch can take up to watch_timeout),
+        pulling can be started again once refreshLabels() sees
+        the daemon ended
+        """
+        self.performPulling = False
+        self.stoppingPulling = True
+        self.entryWidgets["startPulling"]["state"] = "disabled"
+        self.entryWidgets["stopPulling"]["state"] = "disabled"
+        self.puller.kill(wait=False)
+
+    def pullingStopped(self) -> bool:
+        """Pulling daemon terminated after stopPulling()
+
+        Returns:
+            bool: True if window was destroyed
+        """
+        self.stoppingPulling = False
+        if self.closing:
+            self.connection.close()
+            self.destroy()
+            return True
+        self.entryWidgets["startPulling"]["state"] = "normal"
+        return False
+
+    def pullingFailed(self):
+        """Pulling daemon ended with unexpected error
+        (eg. local file can't be written), show it"""
         self.performPulling = False
         self.entryWidgets["startPulling"]["state"] = "normal"
         self.entryWidgets["stopPulling"]["state"] = "disabled"
-        pullFile.kill()
+        tkmsb.showerror("Error", f"Pulling stopped: {self.puller.lastError}")
+
+    def uploadFile(self, *args):
+        """Send local file to server, if server allows editing"""
+        try:
+            sent = pushFile(self.master.config, self.connection)
+        except requests.ConnectionError:
+            tkmsb.showerror(
+                "Error",
+                "Can`t connect to server with given adress, connection denied.",
+            )
+            return None
+        except FatalResponseCode as e:
+            tkmsb.showerror(
+                "Error",
+                f"Server responded with not positive response code: {e.code}",
+            )
+            return None
+        self.uploadedDataVar.set(self.uploadedDataVar.get() + sent)
 
     def endConnection(self, *args):
         """Kills pulling daemon and destroys the connection windows"""
+        if self.stoppingPulling:
+            # pulling is already being stopped, close after it
+            self.entryWidgets["endConnection"]["state"] = "disabled"
+            self.closing = True
+            return None
         if self.performPulling:
             if not tkmsb.askyesno("Alert", "Do you want to close connection?"):
                 return None
             self.entryWidgets["startPulling"]["state"] = "disabled"
             self.entryWidgets["stopPulling"]["state"] = "disabled"
             self.entryWidgets["endConnection"]["state"] = "disabled"
+            # connection is closed once pending pass returns
+            self.closing = True
             self.stopPulling()
+            return None
+        self.connection.close()
         self.destroy()
 
     def destroy(self):
         """Destroy this window and activate entries in main window"""
         self.master.connectionSubWindow = None
         self.master.hasActiveConnection = False
+        if self._refreshJob is not None:
+            self.after_cancel(self._refreshJob)
+            self._refreshJob = None
         # while connection window is created, enties
         # in main window are made disabled, reverse it here
         for _ in map(
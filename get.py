@@ -1,16 +1,548 @@
-from synclib.encryption import EncryptionKey, encrypt, decrypt
+from synclib.encryption import EncryptionKey, encrypt, decrypt, encryptBytes
+from synclib.cache import PayloadCache
+from synclib.metrics import Metrics
+from synclib.manifest import Manifest
+from synclib.watch import Watcher
+import synclib.compression as compression
+from hashlib import blake2b
+from urllib.parse import parse_qs
 import json
+import os
 
+# request metrics of server, exposed on /metrics
+METRICS = Metrics()
+# encrypted payloads of recently served file versions
+PAYLOAD_CACHE = PayloadCache(observer=METRICS.cacheLookup)
+# shared poller of target version for /watch requests
+WATCHER = Watcher()
+# manifests of served directory trees, by path
+MANIFESTS = {}
 
-def getFile(env: dict, response: callable, config: dict):
-    output = b""
+
+def fileIdentity(config: dict, coding: str = None) -> tuple:
+    """Get identity of current version of config["target"],
+    made of file identity from os.stat, encoding settings
+    and compression, so it changes whenever response body
+    would change
+
+    Args:
+        config (dict): server configuration
+        coding (str, optional): compression method of response. Defaults to None.
+
+    Returns:
+        tuple: (path, inode, size, mtime_ns, encode, key, coding, level)
+    """
+    identity = (config["target"], 0, 0, 0)
     if config["target"]:
-        with open(config["target"], "rb") as file:
-            output = file.read()
-        if config["encode"]:
-            output = b"".join(encrypt(output, config["encode_key"]))
-    response("200", [("Content-Type", "text/html")])
-    return [output]
+        stat = os.stat(config["target"])
+        identity = (config["target"], stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    encode = bool(config["encode"])
+    level = config["compression_level"] if coding else 0
+    return identity + (encode, config["encode_key"] if encode else "", coding, level)
+
+
+def requestCoding(env: dict, config: dict) -> str:
+    """Choose compression of response from methods
+    client listed in X-Accept-Compression header
+
+    Args:
+        env (dict): request environment
+        config (dict): server configuration
+
+    Returns:
+        str or None: compression method, None if not compressed
+    """
+    return compression.negotiate(env.get("HTTP_X_ACCEPT_COMPRESSION"), config["compression"])
+
+
+def requestIdentity(env: dict, config: dict) -> tuple:
+    """fileIdentity() of representation negotiated with client"""
+    return fileIdentity(config, requestCoding(env, config))
+
+
+def fileTag(identity: tuple) -> str:
+    """Compute strong validator (ETag) from file identity
+
+    Args:
+        identity (tuple): value returned by fileIdentity()
+
+    Returns:
+        str: quoted ETag value
+    """
+    digest = blake2b(repr(identity).encode("utf-8"), digest_size=16)
+    return f'"{digest.hexdigest()}"'
+
+
+def tagMatches(env: dict, tag: str) -> bool:
+    """Test if If-None-Match header of request matches given tag
+
+    Args:
+        env (dict): request environment
+        tag (str): current ETag value
+
+    Returns:
+        bool: True if client already has this version
+    """
+    header = env.get("HTTP_IF_NONE_MATCH", "")
+    for value in header.split(","):
+        value = value.strip()
+        # weak comparison is used for If-None-Match
+        if value == "*" or value.replace("W/", "", 1) == tag:
+            return True
+    return False
+
+
+def sealBytes(data: bytes, key: str, coding: str = None, level: int = 6) -> bytes:
+    """Compress and encrypt whole payload, compression has
+    to go first, encrypted data doesn't compress
+
+    Args:
+        data (bytes): payload
+        key (str): encoding key, None to skip encryption
+        coding (str, optional): compression method, None to skip. Defaults to None.
+        level (int, optional): compression level. Defaults to 6.
+
+    Returns:
+        bytes: response body
+    """
+    if coding:
+        data = compression.compress(data, coding, level)
+    if key is not None:
+        data = encryptBytes(data, key)
+    return data
+
+
+def sealChunks(chunks, key: str, coding: str = None, level: int = 6, offset: int = 0):
+    """Streaming version of sealBytes(), keystream offset
+    is carried between chunks
+
+    Args:
+        chunks (iterable): payload chunks
+        key (str): encoding key, None to skip encryption
+        coding (str, optional): compression method, None to skip. Defaults to None.
+        level (int, optional): compression level. Defaults to 6.
+        offset (int, optional): position of first chunk in stream. Defaults to 0.
+
+    Yields:
+        bytes: next chunk of response body
+    """
+    compressor = compression.compressor(coding, level) if coding else None
+    for chunk in chunks:
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+            if not chunk:
+                continue
+        if key is not None:
+            chunk = encryptBytes(chunk, key, offset)
+        offset += len(chunk)
+        yield chunk
+    if compressor is not None:
+        chunk = compressor.flush()
+        yield chunk if key is None else encryptBytes(chunk, key, offset)
+
+
+def readPayload(identity: tuple):
+    """Read, compress and encrypt target file described by
+    identity, output is taken from PAYLOAD_CACHE if file
+    didn't change, file is read into single buffer which
+    is encrypted in place and cached
+
+    Args:
+        identity (tuple): value returned by fileIdentity()
+
+    Returns:
+        bytes-like: response body, it must not be modified
+    """
+    path, _, _, _, encode, key, coding, level = identity
+    if not path:
+        return b""
+
+    def seal():
+        # file is read, not mapped, truncating mapped
+        # file would kill server with SIGBUS
+        with open(path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            data = bytearray(stat.st_size)
+            view = memoryview(data)
+            length = 0
+            while length < len(data):
+                read = file.readinto(view[length:])
+                if not read:
+                    break
+                length += read
+            view.release()
+        # file truncated while reading, only what was read is sent
+        del data[length:]
+        if coding:
+            data = compression.compress(data, coding, level)
+            if encode:
+                data = bytearray(data)
+        if encode:
+            data = encryptBytes(data, key, 0, data)
+        # file could be replaced between stat and open, then
+        # content doesn't belong to this identity
+        stable = identity[1:4] == (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        return data, stable and length == stat.st_size
+
+    return PAYLOAD_CACHE.fetch(identity, seal)
+
+
+def isCached(identity: tuple) -> bool:
+    """Test if payload of identity is served from PAYLOAD_CACHE,
+    payloads which differ from file (encrypted or compressed)
+    and fit in cache are
+
+    Args:
+        identity (tuple): value returned by fileIdentity()
+
+    Returns:
+        bool: True if payload is cached
+    """
+    path, _, size, _, encode, _, coding, _ = identity
+    return bool(path) and (encode or bool(coding)) and size <= PAYLOAD_CACHE.maxsize
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def requestedRange(env: dict, size: int, tag: str) -> tuple:
+    """Parse Range header of request, only single byte
+    range is supported, anything else means whole file
+
+    Args:
+        env (dict): request environment
+        size (int): size of target file
+        tag (str): current ETag value, compared with If-Range
+
+    Raises:
+        RangeNotSatisfiable: if range doesn't overlap the file
+
+    Returns:
+        tuple or None: first and last (inclusive) byte of range,
+                        None if whole file should be sent
+    """
+    header = env.get("HTTP_RANGE", "").strip()
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    # range applies only to version client already has part of
+    if env.get("HTTP_IF_RANGE", tag) != tag:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if not first:
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        # malformed range is ignored
+        return None
+    if start < 0 or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def iterFile(file, start: int, stop: int, chunkSize: int):
+    """Read bytes from start to stop of file in chunks
+    of chunkSize bytes and yield them
+
+    Args:
+        file (file object): opened binary file, closed when done
+        start (int): position of first byte to send
+        stop (int): position after last byte to send
+        chunkSize (int): max size of single chunk
+
+    Yields:
+        bytes: next chunk of file
+    """
+    with file:
+        file.seek(start)
+        offset = start
+        while offset < stop:
+            chunk = file.read(min(chunkSize, stop - offset))
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+
+class BufferReader:
+    """
+    Read-only binary file over buffer, lets server send
+    cached payload as wsgi.file_wrapper in blocks (or
+    straight from buffer) without copying it whole
+    """
+
+    mode = "rb"
+
+    def __init__(self, buffer) -> None:
+        self._view = memoryview(buffer)
+        self._position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._view)
+        if size is not None and size >= 0:
+            end = min(end, self._position + size)
+        chunk = bytes(self._view[self._position : end])
+        self._position += len(chunk)
+        return chunk
+
+    def readinto(self, buffer) -> int:
+        chunk = self._view[self._position : self._position + len(buffer)]
+        buffer[: len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        base = (0, self._position, len(self._view))[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def seekable(self) -> bool:
+        return True
+
+    def getbuffer(self) -> memoryview:
+        return self._view
+
+    def close(self) -> None:
+        # slices can still be queued by server, buffer is
+        # released when the last of them is dropped
+        self._view = memoryview(b"")
+
+
+def openPayload(
+    env: dict,
+    identity: tuple,
+    chunkSize: int,
+    start: int = 0,
+    stop: int = None,
+    source=None,
+):
+    """Create response body iterable for part of file version
+    described by identity, payloads fitting in PAYLOAD_CACHE
+    are served from it, others are streamed in chunks so
+    memory used by single request doesn't depend on file size,
+    streamed compressed payload can only be sent whole, ranges
+    sent with wsgi.file_wrapper are limited by Content-Length
+    header, which has to be set by caller
+
+    Args:
+        env (dict): request environment
+        identity (tuple): value returned by fileIdentity()
+        chunkSize (int): max size of single chunk
+        start (int, optional): position of first byte. Defaults to 0.
+        stop (int, optional): position after last byte. Defaults to file size.
+        source (optional): payload already returned by readPayload() if it is
+                        cached, target file opened by caller otherwise. Defaults to None.
+
+    Returns:
+        iterable: response body
+    """
+    path, _, size, _, encode, key, coding, level = identity
+    if not path:
+        return [b""]
+    if isCached(identity):
+        payload = readPayload(identity) if source is None else source
+        stop = len(payload) if stop is None else stop
+        if "wsgi.file_wrapper" in env:
+            # cached buffer is shared by requests, slice of it isn't a copy
+            view = memoryview(payload)[start:stop]
+            return env["wsgi.file_wrapper"](BufferReader(view), chunkSize)
+        if (start, stop) == (0, len(payload)) and isinstance(payload, bytes):
+            return [payload]
+        return [bytes(memoryview(payload)[start:stop])]
+    stop = size if stop is None else stop
+    file = open(path, "rb") if source is None else source
+    if not encode and not coding and "wsgi.file_wrapper" in env:
+        # let server send range of file on its own (sendfile if possible)
+        file.seek(start)
+        return env["wsgi.file_wrapper"](file, chunkSize)
+    return sealChunks(
+        iterFile(file, start, stop, chunkSize),
+        key if encode else None,
+        coding,
+        level,
+        start,
+    )
+
+
+def getFile(env: dict, response: callable, config: dict):
+    if os.path.isdir(config["target"]):
+        # directory targets are synced through /manifest and /getFiles
+        response("409", [("Content-Type", "text/html")])
+        return [b""]
+    PAYLOAD_CACHE.resize(config["cache_size"])
+    identity = requestIdentity(env, config)
+    tag = fileTag(identity)
+    if tagMatches(env, tag):
+        response("304", [("ETag", tag)])
+        return [b""]
+    headers = [("Content-Type", "text/html"), ("ETag", tag)]
+    coding = identity[6]
+    if coding:
+        headers.append(("X-Compression", coding))
+        if not isCached(identity):
+            # length of compressed stream isn't known upfront
+            response("200", headers)
+            return openPayload(env, identity, config["chunk_size"])
+    file = None
+    if not identity[0] or isCached(identity):
+        # cached payload is what ranges refer to, it is made
+        # only once, even if it can't be cached
+        source = readPayload(identity)
+        size = len(source)
+    else:
+        # length has to match body even if file is replaced meanwhile,
+        # so it is taken from file which is sent
+        source = file = open(identity[0], "rb")
+        stat = os.fstat(file.fileno())
+        size = stat.st_size
+        tag = fileTag((identity[0], stat.st_ino, size, stat.st_mtime_ns) + identity[4:])
+        headers[1] = ("ETag", tag)
+    try:
+        span = requestedRange(env, size, tag)
+    except RangeNotSatisfiable:
+        if file is not None:
+            file.close()
+        response("416", [("Content-Range", f"bytes */{size}"), ("ETag", tag)])
+        return [b""]
+    start, end = span or (0, size - 1)
+    output = openPayload(env, identity, config["chunk_size"], start, end + 1, source)
+    headers.append(("Accept-Ranges", "bytes"))
+    if span is None:
+        response("200", headers + [("Content-Length", str(size))])
+    else:
+        response(
+            "206",
+            headers
+            + [
+                ("Content-Range", f"bytes {start}-{end}/{size}"),
+                ("Content-Length", str(end + 1 - start)),
+            ],
+        )
+    return output
+
+
+def watchRequest(env: dict, config: dict) -> tuple:
+    """Parse /watch request
+
+    Args:
+        env (dict): request environment
+        config (dict): server configuration
+
+    Returns:
+        tuple: timeout (query parameter, limited by watch_timeout),
+                function returning current identity of target, the
+                same for all representations, so single watcher
+                polls it for every waiter, and function making
+                ETag of negotiated representation from identity
+    """
+    timeout = config["watch_timeout"]
+    query = parse_qs(env.get("QUERY_STRING", ""))
+    if "timeout" in query:
+        timeout = min(float(query["timeout"][0]), timeout)
+    coding = requestCoding(env, config)
+    level = config["compression_level"] if coding else 0
+    return (
+        timeout,
+        lambda: fileIdentity(config),
+        lambda identity: fileTag(identity[:6] + (coding, level)),
+    )
+
+
+def watchResponse(env: dict, response: callable, tag: str):
+    """Answer /watch request, 304 if client has version
+    with given tag, 200 with new ETag otherwise
+    """
+    if tagMatches(env, tag):
+        response("304", [("ETag", tag)])
+    else:
+        response("200", [("Content-Type", "text/html"), ("ETag", tag)])
+    return [b""]
+
+
+def watch(env: dict, response: callable, config: dict):
+    """Long poll, blocks until version of target differs from
+    the one sent by client in If-None-Match header or until
+    timeout (query parameter, limited by watch_timeout) expires,
+    answers 304 on timeout and 200 with new ETag on change
+    """
+    timeout, probe, represent = watchRequest(env, config)
+    identity = probe()
+    if tagMatches(env, represent(identity)):
+        WATCHER.interval = config["watch_interval"]
+        identity = WATCHER.wait(probe, identity, timeout)
+    return watchResponse(env, response, represent(identity))
+
+
+def getManifest(config: dict) -> Manifest:
+    """Get manifest of directory target, manifest is kept
+    between requests so it is updated incrementally
+
+    Args:
+        config (dict): server configuration
+
+    Returns:
+        Manifest: manifest of config["target"]
+    """
+    manifest = MANIFESTS.get(config["target"])
+    if manifest is None:
+        manifest = MANIFESTS.setdefault(config["target"], Manifest(config["target"]))
+    manifest.interval = config["manifest_interval"]
+    return manifest
+
+
+def manifest(env: dict, response: callable, config: dict):
+    """Send listing (JSON, encrypted if encoding is on) of files
+    in directory target with their size, mtime and content hash
+    """
+    if not config["target"] or not os.path.isdir(config["target"]):
+        response("404", [("Content-Type", "text/html")])
+        return [b""]
+    listing = getManifest(config)
+    version = listing.refresh()
+    encode = bool(config["encode"])
+    coding = requestCoding(env, config)
+    key = config["encode_key"] if encode else None
+    tag = fileTag((config["target"], version, key, coding, config["compression_level"]))
+    if tagMatches(env, tag):
+        response("304", [("ETag", tag)])
+        return [b""]
+    data = sealBytes(listing.toJson(), key, coding, config["compression_level"])
+    headers = [
+        ("Content-Type", "application/json"),
+        ("Content-Length", str(len(data))),
+        ("ETag", tag),
+    ]
+    if coding:
+        headers.append(("X-Compression", coding))
+    response("200", headers)
+    return [data]
+
+
+def metrics(env: dict, response: callable, config: dict):
+    """Send request metrics in Prometheus text format"""
+    if not config["metrics"]:
+        response("404", [("Content-Type", "text/html")])
+        return [b""]
+    data = METRICS.render(
+        {
+            "synclib_cache_bytes": PAYLOAD_CACHE.size,
+            "synclib_cache_max_bytes": PAYLOAD_CACHE.maxsize,
+        }
+    )
+    response(
+        "200",
+        [
+            ("Content-Type", "text/plain; version=0.0.4"),
+            ("Content-Length", str(len(data))),
+        ],
+    )
+    return [data]
 
 
 def connect(env: dict, response: callable, config: dict):
@@ -21,8 +553,14 @@ def connect(env: dict, response: callable, config: dict):
     }
     data = json.dumps(data).encode("utf-8")
     if config["encode"]:
-        data = b"".join(encrypt(data, config["encode_key"]))
+        data = encryptBytes(data, config["encode_key"])
     return [data]
 
 
-URLS = {"/getFile": getFile, "/connect": connect}
\ No newline at end of file
+URLS = {
+    "/getFile": getFile,
+    "/watch": watch,
+    "/manifest": manifest,
+    "/metrics": metrics,
+    "/connect": connect,
+}
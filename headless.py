@@ -0,0 +1,95 @@
+import argparse
+import logging
+import signal
+import sys
+import threading
+import synclib.config as config
+
+"""
+Sync client without GUI, reads ClientCFG, makes the same /connect
+handshake as client.py and runs pulling daemon until interrupted,
+tkinter is never imported and requests (with numpy, if encoding
+is on) are imported only once connection is made
+"""
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Pull server target without GUI.")
+    parser.add_argument("--config", default="./client.cfg", help="client config file")
+    parser.add_argument("--once", action="store_true", help="pull once and exit")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every pull")
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    setup = config.ClientCFG(args.config)
+    # heavy imports are deferred until they are needed
+    import synclib.compression as compression
+    from synclib.connection import Connection
+    import synclib.engine as engine
+    from synclib.stats import TransferStats
+
+    connection = Connection(
+        setup["address"],
+        setup["port"],
+        setup["pool_size"],
+        setup["timeout"],
+        {"X-Accept-Compression": ", ".join(compression.METHODS)}
+        if setup["compression"]
+        else None,
+    )
+    stats = TransferStats()
+    with connection:
+        try:
+            engine.handshake(stats, setup, connection)
+        except OSError as e:
+            logging.error(f"Can't connect to server: {e}")
+            return 1
+        except engine.FatalResponseCode as e:
+            logging.error(f"Server responded with not positive response code: {e.code}")
+            return 1
+        except engine.UnwantedConnectionError:
+            logging.error("Server refused connection.")
+            return 1
+        except (ValueError, KeyError):
+            logging.error("Parsing server response failed, probably invalid key.")
+            return 1
+        puller = engine.preparePulling(setup)
+        if args.once:
+            changed = False
+            for task in puller.getTasks():
+                changed = bool(task(stats, setup, connection)) or changed
+            logging.info(f"Pulled {stats.bytes} B, changed: {changed}")
+            return 0
+        stop = threading.Event()
+        for name in ("SIGINT", "SIGTERM"):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), lambda *args: stop.set())
+        puller(stats, setup, connection)
+        last = 0
+        while not stop.wait(1.0):
+            if not puller.isAlive():
+                # ended by unexpected error, traceback is already logged
+                logging.error(f"Pulling stopped: {puller.lastError!r}")
+                return 1
+            if args.verbose and stats.requests != last:
+                sample = stats.snapshot()
+                last = sample["requests"]
+                logging.info(
+                    f"Pulled {sample['bytes']} B in {last} requests, "
+                    f"{sample['errors']} errors, interval {puller.interval:.3f} s"
+                )
+        # pending watch request can take up to watch_timeout,
+        # second interrupt quits without waiting for it
+        puller.kill(wait=False)
+        stop.clear()
+        if puller.isAlive():
+            logging.warning("Waiting for pending request, interrupt again to quit.")
+        while puller.isAlive() and not stop.wait(0.1):
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
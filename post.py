@@ -0,0 +1,126 @@
+from synclib.encryption import EncryptionKey, decryptBytes
+from synclib.manifest import RECORD
+import synclib.delta as delta
+import get
+import json
+import os
+
+
+def readBody(env: dict) -> bytes:
+    """Read request body of length given by Content-Length
+
+    Args:
+        env (dict): request environment
+
+    Returns:
+        bytes: request body
+    """
+    length = int(env.get("CONTENT_LENGTH") or 0)
+    return env["wsgi.input"].read(length) if length > 0 else b""
+
+
+def getDelta(env: dict, response: callable, config: dict):
+    """Send instruction stream rebuilding current target
+    from client's local copy, described by block signature
+    sent (encrypted if encoding is on) in request body
+    """
+    if os.path.isdir(config["target"]):
+        # directory targets are synced through /manifest and /getFiles
+        response("409", [("Content-Type", "text/html")])
+        return [b""]
+    identity = get.requestIdentity(env, config)
+    tag = get.fileTag(identity)
+    if get.tagMatches(env, tag):
+        response("304", [("ETag", tag)])
+        return [b""]
+    signature = readBody(env)
+    if config["encode"]:
+        signature = decryptBytes(signature, config["encode_key"])
+    data = b""
+    if config["target"]:
+        with open(config["target"], "rb") as file:
+            data = file.read()
+    # mostly rewritten file is cheaper to send whole, from
+    # payload cache, than to roll checksum over all of it
+    instructions = delta.makeDelta(data, signature, len(data) // 2)
+    if instructions is None:
+        response("303", [("Content-Type", "text/html"), ("Location", "/getFile")])
+        return [b""]
+    coding, level = identity[6:8]
+    output = get.sealBytes(
+        instructions,
+        config["encode_key"] if config["encode"] else None,
+        coding,
+        level,
+    )
+    headers = [
+        ("Content-Type", "application/octet-stream"),
+        ("Content-Length", str(len(output))),
+        ("ETag", tag),
+    ]
+    if coding:
+        headers.append(("X-Compression", coding))
+    response("200", headers)
+    return [output]
+
+
+def iterFiles(manifest, paths: list, chunkSize: int):
+    """Yield batched stream of files, each file is a record
+    header (path length, size), utf-8 path and content
+
+    Args:
+        manifest (Manifest): manifest of served tree
+        paths (list): relative paths of files to send
+        chunkSize (int): max size of single chunk
+
+    Yields:
+        bytes: next chunk of stream
+    """
+    for relpath in paths:
+        try:
+            file = open(manifest.resolve(relpath), "rb")
+        except OSError:
+            # removed since manifest was sent, client will notice
+            continue
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            name = relpath.encode("utf-8")
+            yield RECORD.pack(len(name), size) + name
+            remaining = size
+            while remaining:
+                # file shrunk while sending, pad it to announced size
+                chunk = file.read(min(chunkSize, remaining)) or bytes(
+                    min(chunkSize, remaining)
+                )
+                remaining -= len(chunk)
+                yield chunk
+
+
+def getFiles(env: dict, response: callable, config: dict):
+    """Send files listed in request body (JSON, encrypted if encoding
+    is on) from directory target in one batched stream, encrypted
+    and compressed as a whole, only files present in manifest are sent
+    """
+    if not config["target"] or not os.path.isdir(config["target"]):
+        response("404", [("Content-Type", "text/html")])
+        return [b""]
+    request = readBody(env)
+    if config["encode"]:
+        request = decryptBytes(request, config["encode_key"])
+    manifest = get.getManifest(config)
+    manifest.refresh()
+    paths = [path for path in json.loads(request)["files"] if path in manifest.entries]
+    coding = get.requestCoding(env, config)
+    headers = [("Content-Type", "application/octet-stream")]
+    if coding:
+        headers.append(("X-Compression", coding))
+    response("200", headers)
+    return get.sealChunks(
+        iterFiles(manifest, paths, config["chunk_size"]),
+        config["encode_key"] if config["encode"] else None,
+        coding,
+        config["compression_level"],
+    )
+
+
+URLS = {"/getDelta": getDelta, "/getFiles": getFiles}
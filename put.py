@@ -1,4 +1,121 @@
-from synclib.encryption import EncryptionKey, encrypt, decrypt
+from synclib.encryption import EncryptionKey, encrypt, decrypt, decryptBytes
+from contextlib import contextmanager
+from threading import Lock
+import get
+import os
+import stat
+import tempfile
 
+try:
+    import fcntl
+except ImportError:
+    # single process server only, writers are serialized by WRITE_LOCK
+    fcntl = None
 
-URLS = {}
+# serializes writers of target in this process, readers never wait for it
+WRITE_LOCK = Lock()
+
+
+def iterBody(env: dict, chunkSize: int):
+    """Read request body in chunks of at most chunkSize bytes,
+    body length is taken from Content-Length, or body is read
+    until end if server already terminated it (chunked upload)
+
+    Args:
+        env (dict): request environment
+        chunkSize (int): max size of single chunk
+
+    Raises:
+        ValueError: if body is shorter than Content-Length
+
+    Yields:
+        tuple: offset of chunk in body and chunk bytes
+    """
+    stream = env["wsgi.input"]
+    length = env.get("CONTENT_LENGTH")
+    remaining = int(length) if length else None
+    if remaining is None and not env.get("wsgi.input_terminated"):
+        remaining = 0
+    offset = 0
+    while remaining is None or remaining > 0:
+        size = chunkSize if remaining is None else min(chunkSize, remaining)
+        chunk = stream.read(size)
+        if not chunk:
+            if remaining is not None:
+                raise ValueError("Incomplete request body.")
+            break
+        yield offset, chunk
+        offset += len(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+
+
+def currentTag(env: dict, config: dict) -> str:
+    """Get ETag of target in representation negotiated
+    with client, None if it doesn't exist"""
+    try:
+        return get.fileTag(get.requestIdentity(env, config))
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def writeLock(path: str):
+    """Hold lock serializing writers of path, shared with
+    other worker processes through lock file next to path,
+    lock file is never removed as others may be waiting on it
+    """
+    with WRITE_LOCK:
+        if fcntl is None:
+            yield None
+            return None
+        directory, name = os.path.split(os.path.abspath(path))
+        with open(os.path.join(directory, f".{name}.lock"), "wb") as file:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield file
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+def putFile(env: dict, response: callable, config: dict):
+    """Replace target with request body (encrypted if encoding
+    is on), body is streamed into temporary file which is then
+    atomically renamed onto target, so readers never see torn
+    file, If-Match header makes upload conditional
+    """
+    if not config["allow_edit"] or not config["target"]:
+        response("403", [("Content-Type", "text/html")])
+        return [b""]
+    if os.path.isdir(config["target"]):
+        # directory targets can't be replaced by single file
+        response("409", [("Content-Type", "text/html")])
+        return [b""]
+    path = config["target"]
+    with writeLock(path):
+        expected = env.get("HTTP_IF_MATCH", "").strip()
+        if expected and expected != "*" and expected != currentTag(env, config):
+            response("412", [("Content-Type", "text/html")])
+            return [b""]
+        # temporary file in the same directory, os.replace can't cross filesystems
+        fd, temp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), prefix=".", suffix=".part"
+        )
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for offset, chunk in iterBody(env, config["chunk_size"]):
+                    if config["encode"]:
+                        chunk = decryptBytes(chunk, config["encode_key"], offset)
+                    file.write(chunk)
+            if os.path.exists(path):
+                os.chmod(temp, stat.S_IMODE(os.stat(path).st_mode))
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        tag = currentTag(env, config)
+    response("200", [("Content-Type", "text/html"), ("ETag", tag)])
+    return [b""]
+
+
+URLS = {"/putFile": putFile}
@@ -1,7 +1,19 @@
+import asyncio
+import os
+import shutil
+import signal
+import tempfile
+import time
 import waitress
 import get
+import post
 import put
+import synclib.aioserver as aioserver
 import synclib.config as config
+import synclib.encryption as encryption
+import synclib.prefork as prefork
+from synclib.cache import SharedPayloadCache
+from synclib.watch import AsyncWatcher
 
 """
 REMOTE_ADDR 192.168.1.181
@@ -33,9 +45,34 @@ HTTP_CONNECTION keep-alive
 HTTP_UPGRADE_INSECURE_REQUESTS 1
 """
 
+# server configuration kept in memory, reloaded when file changes
+CONFIG = config.CachedCFG(config.ServerCFG, "./server.cfg")
+# shared poller of target version for /watch on asyncio server
+ASYNC_WATCHER = AsyncWatcher()
+# every known path has its own metrics, the rest is counted together
+PATHS = set(get.URLS) | set(post.URLS) | set(put.URLS)
+
+
+def instrument(enabled: bool) -> None:
+    """Attach metrics to cipher (time spent in it is added to
+    current request) and payload cache, or detach them, so
+    requests pay nothing for metrics while they are off"""
+    encryption.OBSERVER = get.METRICS.encryption if enabled else None
+    get.PAYLOAD_CACHE.observer = get.METRICS.cacheLookup if enabled else None
+
 
 def main(env: dict, response: callable):
-    cfg = config.ServerCFG("./server.cfg")
+    enabled = CONFIG.get()["metrics"]
+    if (encryption.OBSERVER is not None) != enabled:
+        instrument(enabled)
+    if not enabled:
+        return dispatch(env, response)
+    path = env.get("PATH_INFO", "")
+    return get.METRICS.observe(path if path in PATHS else "other", dispatch, env, response)
+
+
+def dispatch(env: dict, response: callable):
+    cfg = CONFIG.get()
     try:
         if env["REQUEST_METHOD"] == "GET":
             return get.URLS.get(
@@ -44,6 +81,13 @@ def main(env: dict, response: callable):
                 if [response("200", [("Content-Type", "text/html")])]
                 else None,
             )(env, response, cfg)
+        elif env["REQUEST_METHOD"] == "POST":
+            return post.URLS.get(
+                env["PATH_INFO"],
+                lambda env, response, cfg: b""
+                if [response("200", [("Content-Type", "text/html")])]
+                else None,
+            )(env, response, cfg)
         elif env["REQUEST_METHOD"] == "PUT":
             return put.URLS.get(
                 env["PATH_INFO"],
@@ -59,6 +103,68 @@ def main(env: dict, response: callable):
         return [b""]
 
 
+async def watch(env: dict, response: callable, executor):
+    """/watch for asyncio server, waiting request doesn't hold
+    a thread, only version probe runs in executor
+    """
+    start = time.perf_counter()
+    cfg = CONFIG.get()
+    try:
+        timeout, probe, represent = get.watchRequest(env, cfg)
+    except ValueError:
+        response("500", [("Content-Type", "application/octet-stream")])
+        if cfg["metrics"]:
+            get.METRICS.record("/watch", time.perf_counter() - start, "500")
+        return [b""]
+    loop = asyncio.get_running_loop()
+    identity = await loop.run_in_executor(executor, probe)
+    if get.tagMatches(env, represent(identity)):
+        ASYNC_WATCHER.interval = cfg["watch_interval"]
+        identity = await ASYNC_WATCHER.wait(probe, identity, timeout, executor)
+    tag = represent(identity)
+    if cfg["metrics"]:
+        status = "304" if get.tagMatches(env, tag) else "200"
+        get.METRICS.record("/watch", time.perf_counter() - start, status)
+    return get.watchResponse(env, response, tag)
+
+
+def run(sock=None):
+    """Serve with backend selected in config, on sock
+    (inherited from prefork master) if it is given"""
+    cfg = CONFIG.get()
+    address = {"host": "0.0.0.0", "port": "8080"}
+    if sock is not None:
+        address = {"sockets": [sock]}
+    if cfg["server"] == "asyncio":
+        # idle connections and /watch requests don't hold threads
+        aioserver.serve(
+            main,
+            host="0.0.0.0",
+            port="8080",
+            threads=cfg["threads"],
+            handlers={("GET", "/watch"): watch},
+            sock=sock,
+        )
+    else:
+        # long polling /watch requests hold a thread each
+        waitress.serve(main, threads=cfg["threads"], **address)
+
+
 if __name__ == "__main__":
-    config.ServerCFG("./server.cfg")
-    waitress.serve(main, host="0.0.0.0", port="8080")
+    cfg = CONFIG.get()
+    # SIGHUP forces config reload
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda *args: CONFIG.invalidate())
+    if cfg["workers"] != 1 and hasattr(os, "fork"):
+        # payload is encrypted by one worker and mapped by all of them,
+        # metrics are still kept by each worker on its own
+        directory = tempfile.mkdtemp(prefix="synclib-cache-")
+        get.PAYLOAD_CACHE = SharedPayloadCache(
+            directory, cfg["cache_size"], get.METRICS.cacheLookup
+        )
+        try:
+            prefork.serve(run, host="0.0.0.0", port="8080", workers=cfg["workers"])
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    else:
+        run()
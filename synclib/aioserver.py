@@ -0,0 +1,352 @@
+# -*- encoding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from tempfile import SpooledTemporaryFile
+from typing import Callable, Dict, Tuple
+from urllib.parse import unquote
+import asyncio
+import io
+import logging
+import sys
+
+# request bodies larger than this are spooled to disk
+SPOOL_SIZE = 1048576
+# seconds idle keep-alive connection is kept open
+IDLE_TIMEOUT = 300.0
+# limit of header lines in single request
+MAX_HEADERS = 100
+# status codes sent without body
+NO_BODY = (204, 304)
+# largest slice of in-memory file written at once
+WRITE_SIZE = 1048576
+
+
+class FileWrapper:
+    """
+    wsgi.file_wrapper, file returned in it is sent
+    with loop.sendfile() from its current position
+    to the end or Content-Length bytes, in-memory
+    files (with getbuffer()) are written directly
+    """
+
+    def __init__(self, file, blockSize: int = 65536) -> None:
+        self.file = file
+        self.blockSize = blockSize
+
+    def __iter__(self):
+        return iter(lambda: self.file.read(self.blockSize), b"")
+
+    def close(self):
+        self.file.close()
+
+
+class BadRequest(Exception):
+    pass
+
+
+class AsyncWSGIServer:
+    """
+    HTTP/1.1 server running WSGI application on asyncio,
+    open and idle keep-alive connections cost no thread,
+    application and blocking response bodies are run in
+    thread pool, selected requests can be served by async
+    handlers instead, which don't take thread at all
+    """
+
+    def __init__(
+        self,
+        app: Callable,
+        threads: int = 16,
+        handlers: Dict[Tuple[str, str], Callable] = None,
+    ) -> None:
+        """
+        Args:
+            app (callable): WSGI application
+            threads (int, optional): size of thread pool. Defaults to 16.
+            handlers (dict, optional): async handlers by (method, path), called as
+                                    handler(env, response, executor) and returning
+                                    response body like WSGI application. Defaults to None.
+        """
+        self.app = app
+        self.handlers = handlers or {}
+        self.executor = ThreadPoolExecutor(threads)
+
+    async def serve(self, host: str, port: int, sock=None) -> None:
+        """Accept connections until cancelled, on sock
+        instead of host and port if it is given"""
+        if sock is not None:
+            server = await asyncio.start_server(self.__connection__, sock=sock)
+        else:
+            server = await asyncio.start_server(self.__connection__, host, port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    async def __connection__(self, reader, writer):
+        """Serve requests of single keep-alive connection"""
+        peer = writer.get_extra_info("peername") or ("", 0)
+        sock = writer.get_extra_info("sockname") or ("", 0)
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not line:
+                    break
+                if line in (b"\r\n", b"\n"):
+                    # tolerate empty line between requests
+                    continue
+                try:
+                    env = await self._readRequest(line, reader, peer, sock)
+                except BadRequest:
+                    writer.write(
+                        b"HTTP/1.1 400 Bad Request\r\n"
+                        b"Connection: close\r\nContent-Length: 0\r\n\r\n"
+                    )
+                    break
+                if not await self._respond(env, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except Exception as e:
+            # failure after headers were sent, connection can't be reused
+            logging.exception(e, exc_info=True)
+        finally:
+            writer.close()
+
+    async def _readRequest(self, line: bytes, reader, peer: tuple, sock: tuple) -> dict:
+        """Parse request line, headers and read body into WSGI environment"""
+        try:
+            method, target, protocol = line.decode("latin-1").split()
+        except ValueError:
+            raise BadRequest()
+        path, _, query = target.partition("?")
+        env = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, "latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": str(sock[0]),
+            "SERVER_PORT": str(sock[1]),
+            "SERVER_PROTOCOL": protocol,
+            "SERVER_SOFTWARE": "synclib.aioserver",
+            "REMOTE_ADDR": str(peer[0]),
+            "REMOTE_PORT": str(peer[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": FileWrapper,
+            "wsgi.input_terminated": True,
+        }
+        for _ in range(MAX_HEADERS):
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, separator, value = line.partition(":")
+            if not separator:
+                raise BadRequest()
+            name = name.strip().upper().replace("-", "_")
+            value = value.strip()
+            if name in ("CONTENT_LENGTH", "CONTENT_TYPE"):
+                env[name] = value
+            else:
+                key = "HTTP_" + name
+                env[key] = f"{env[key]},{value}" if key in env else value
+        else:
+            raise BadRequest()
+        env["wsgi.input"] = await self._readBody(env, reader)
+        return env
+
+    async def _readBody(self, env: dict, reader):
+        """Read whole request body, body is spooled to disk
+        (in thread pool) once it exceeds SPOOL_SIZE
+        """
+        chunked = env.get("HTTP_TRANSFER_ENCODING", "").lower() == "chunked"
+        try:
+            remaining = int(env.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            raise BadRequest()
+        if not chunked and remaining <= 0:
+            return io.BytesIO(b"")
+        loop = asyncio.get_running_loop()
+        body = SpooledTemporaryFile(SPOOL_SIZE)
+        length = 0
+        while True:
+            if chunked:
+                try:
+                    size = int((await reader.readline()).split(b";")[0], 16)
+                except ValueError:
+                    raise BadRequest()
+                if not size:
+                    # skip trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunk = await reader.readexactly(size)
+                await reader.readline()
+            else:
+                if not remaining:
+                    break
+                chunk = await reader.readexactly(min(remaining, 65536))
+                remaining -= len(chunk)
+            length += len(chunk)
+            if length > SPOOL_SIZE:
+                await loop.run_in_executor(self.executor, body.write, chunk)
+            else:
+                body.write(chunk)
+        body.seek(0)
+        env["CONTENT_LENGTH"] = str(length)
+        env.pop("HTTP_TRANSFER_ENCODING", None)
+        return body
+
+    async def _respond(self, env: dict, writer) -> bool:
+        """Run application or async handler and send its response
+
+        Returns:
+            bool: True if connection can be kept open
+        """
+        loop = asyncio.get_running_loop()
+        state = {}
+
+        def response(status, headers, exc_info=None):
+            if exc_info and state.get("sent"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            state["status"] = status
+            state["headers"] = headers
+            return lambda data: state.setdefault("written", []).append(data)
+
+        protocol = env["SERVER_PROTOCOL"]
+        connection = env.get("HTTP_CONNECTION", "").lower()
+        keepAlive = (
+            connection == "keep-alive"
+            if protocol == "HTTP/1.0"
+            else connection != "close"
+        )
+        handler = self.handlers.get((env["REQUEST_METHOD"], env["PATH_INFO"]))
+        try:
+            if handler is not None:
+                result = await handler(env, response, self.executor)
+            else:
+                result = await loop.run_in_executor(self.executor, self.app, env, response)
+        except Exception as e:
+            logging.exception(e, exc_info=True)
+            writer.write(b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+            return keepAlive
+        finally:
+            env["wsgi.input"].close()
+        if isinstance(result, bytes):
+            result = [result]
+        try:
+            return await self._sendBody(env, writer, state, result, keepAlive)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    async def _sendBody(self, env: dict, writer, state: dict, result, keepAlive: bool) -> bool:
+        """Send status line, headers and body of response"""
+        loop = asyncio.get_running_loop()
+        if isinstance(result, (list, tuple)):
+            first, rest = b"".join(result), None
+        elif isinstance(result, FileWrapper):
+            first, rest = b"", None
+        else:
+            rest = iter(result)
+            # headers can be set until first chunk is produced
+            first = await loop.run_in_executor(self.executor, next, rest, None)
+            first = first if first is not None else b""
+        first = b"".join(state.pop("written", [])) + first
+        status = state.get("status", "500")
+        code = int(status.split()[0])
+        if " " not in status.strip():
+            try:
+                status = f"{code} {HTTPStatus(code).phrase}"
+            except ValueError:
+                pass
+        names = {name.lower() for name, _ in state.get("headers", [])}
+        noBody = code in NO_BODY or code < 200 or env["REQUEST_METHOD"] == "HEAD"
+        chunked = not noBody and "content-length" not in names
+        if chunked and env["SERVER_PROTOCOL"] == "HTTP/1.0":
+            # length of body is marked by closing connection
+            chunked, keepAlive = False, False
+        lines = [f"HTTP/1.1 {status}"]
+        lines += [f"{name}: {value}" for name, value in state.get("headers", [])]
+        if chunked:
+            lines.append("Transfer-Encoding: chunked")
+        if not keepAlive:
+            lines.append("Connection: close")
+        state["sent"] = True
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if noBody:
+            await writer.drain()
+            return keepAlive
+        if isinstance(result, FileWrapper):
+            await self._sendFile(writer, state, result.file)
+            return keepAlive
+        self._write(writer, first, chunked)
+        await writer.drain()
+        while rest is not None:
+            chunk = await loop.run_in_executor(self.executor, next, rest, None)
+            if chunk is None:
+                break
+            self._write(writer, chunk, chunked)
+            await writer.drain()
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        return keepAlive
+
+    async def _sendFile(self, writer, state: dict, file) -> None:
+        """Send body of wsgi.file_wrapper response"""
+        count = None
+        for name, value in state.get("headers", []):
+            if name.lower() == "content-length":
+                count = int(value)
+        if not hasattr(file, "getbuffer"):
+            if count != 0:
+                loop = asyncio.get_running_loop()
+                await loop.sendfile(writer.transport, file, file.tell(), count)
+            return None
+        view = file.getbuffer()[file.tell() :]
+        if count is not None:
+            view = view[:count]
+        for start in range(0, len(view), WRITE_SIZE):
+            writer.write(view[start : start + WRITE_SIZE])
+            await writer.drain()
+
+    def _write(self, writer, data: bytes, chunked: bool):
+        if not data:
+            return None
+        if chunked:
+            writer.write(b"%x\r\n" % len(data) + bytes(data) + b"\r\n")
+        else:
+            writer.write(data)
+
+
+def serve(
+    app: Callable,
+    host: str = "0.0.0.0",
+    port: int = 8080,
+    threads: int = 16,
+    handlers: Dict[Tuple[str, str], Callable] = None,
+    sock=None,
+) -> None:
+    """Serve WSGI application with AsyncWSGIServer until interrupted
+
+    Args:
+        app (callable): WSGI application
+        host (str, optional): address to listen on. Defaults to "0.0.0.0".
+        port (int, optional): port to listen on. Defaults to 8080.
+        threads (int, optional): size of thread pool. Defaults to 16.
+        handlers (dict, optional): async handlers by (method, path). Defaults to None.
+        sock (socket.socket, optional): listening socket used instead
+                                    of host and port. Defaults to None.
+    """
+    server = AsyncWSGIServer(app, threads, handlers)
+    try:
+        asyncio.run(server.serve(host, int(port), sock))
+    except KeyboardInterrupt:
+        pass
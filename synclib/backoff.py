@@ -0,0 +1,52 @@
+# -*- encoding: utf-8 -*-
+
+
+class Backoff:
+    """
+    Adaptive polling interval, reset to minimum after change,
+    growing exponentially while nothing changes and, separately,
+    with each consecutive failure, never above maximum
+    """
+
+    def __init__(
+        self,
+        minimum: float = 0.1,
+        maximum: float = 10.0,
+        factor: float = 2.0,
+        retry: float = None,
+    ) -> None:
+        """
+        Args:
+            minimum (float, optional): interval right after change. Defaults to 0.1.
+            maximum (float, optional): upper bound of interval. Defaults to 10.0.
+            factor (float, optional): growth of interval per step. Defaults to 2.0.
+            retry (float, optional): interval after first failure. Defaults to minimum.
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.retry = retry
+        self.interval = minimum
+        self.failures = 0
+
+    def reset(self) -> None:
+        """Start over from minimum interval"""
+        self.failures = 0
+        self.interval = self.minimum
+
+    def changed(self) -> None:
+        """Poll found a change, next one comes soon"""
+        self.reset()
+
+    def idle(self) -> None:
+        """Poll found nothing new, wait longer next time"""
+        if self.failures:
+            self.reset()
+        else:
+            self.interval = min(self.maximum, max(self.interval, self.minimum) * self.factor)
+
+    def failed(self) -> None:
+        """Poll failed, retry after exponentially longer wait"""
+        self.failures += 1
+        retry = self.retry if self.retry is not None else self.minimum
+        self.interval = min(self.maximum, retry * self.factor ** (self.failures - 1))
@@ -0,0 +1,317 @@
+# -*- encoding: utf-8 -*-
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import blake2b
+from threading import Lock
+from typing import Any, Callable, Hashable
+import mmap
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # no cross process locking, payload can be made more than once
+    fcntl = None
+
+# payloads mapped by single process at once
+MAPPED_PAYLOADS = 16
+# lock files shared by all keys, they are never removed
+# as other processes may be waiting on them
+LOCK_STRIPES = 64
+
+
+class PayloadCache:
+    """
+    Thread safe LRU cache of response payloads
+    limited by total size of stored bytes
+    """
+
+    def __init__(self, maxsize: int = 64 * 1048576, observer: Callable = None) -> None:
+        """Create empty cache
+
+        Args:
+            maxsize (int, optional): memory budget in bytes. Defaults to 64 MiB.
+            observer (callable, optional): called with True on hit and False on miss. Defaults to None.
+        """
+        self.maxsize = maxsize
+        self.observer = observer
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Any:
+        """Get payload stored for given key
+
+        Args:
+            key (hashable): payload identity
+
+        Returns:
+            bytes or None: payload, None if not cached
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+        if self.observer is not None:
+            self.observer(value is not None)
+        return value
+
+    def put(self, key: Hashable, value: bytes) -> None:
+        """Store payload, evicting least recently used
+        ones if memory budget is exceeded, payloads
+        bigger than whole budget are not stored
+
+        Args:
+            key (hashable): payload identity
+            value (bytes): payload
+        """
+        if len(value) > self.maxsize:
+            return None
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._entries[key] = value
+            self.size += len(value)
+            self._evict()
+
+    def fetch(self, key: Hashable, factory: Callable) -> bytes:
+        """Get payload stored for given key, on miss payload
+        is made by factory and stored if factory allows it
+
+        Args:
+            key (hashable): payload identity
+            factory (callable): returns payload and bool telling
+                                if it can be stored under key
+
+        Returns:
+            bytes: payload
+        """
+        value = self.get(key)
+        if value is None:
+            value, keep = factory()
+            if keep:
+                self.put(key, value)
+        return value
+
+    def resize(self, maxsize: int) -> None:
+        """Change memory budget, evicts entries if needed
+
+        Args:
+            maxsize (int): new memory budget in bytes
+        """
+        if maxsize == self.maxsize:
+            return None
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self) -> None:
+        """Remove all cached payloads"""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _evict(self) -> None:
+        """Drop least recently used payloads until
+        memory budget is met, lock has to be held
+        """
+        while self.size > self.maxsize and self._entries:
+            _, value = self._entries.popitem(last=False)
+            self.size -= len(value)
+
+
+class SharedPayloadCache:
+    """
+    Cache of response payloads shared by worker processes, every
+    payload is published as file in common directory and mapped
+    into memory by readers, so it is made by single process and
+    page cache holds one copy of it for all of them, directory
+    is limited by total size of stored bytes, oldest payloads
+    are removed first
+    """
+
+    def __init__(
+        self, directory: str, maxsize: int = 64 * 1048576, observer: Callable = None
+    ) -> None:
+        """Create cache in existing directory
+
+        Args:
+            directory (str): directory shared by processes
+            maxsize (int, optional): memory budget in bytes. Defaults to 64 MiB.
+            observer (callable, optional): called with True on hit and False on miss. Defaults to None.
+        """
+        self.directory = directory
+        self.maxsize = maxsize
+        self.observer = observer
+        # bytes in directory when this process last looked
+        # plus bytes it published since, directory is only
+        # scanned when this estimate is over budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._maps = OrderedDict()
+        self._lock = Lock()
+
+    def _path(self, key: Hashable, suffix: str = ".payload") -> str:
+        name = blake2b(repr(key).encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.directory, name + suffix)
+
+    def _load(self, key: Hashable) -> Any:
+        """Get mapping of published payload, mappings are kept
+        open and returned without copying, payload of key never
+        changes once published
+        """
+        path = self._path(key)
+        with self._lock:
+            mapped = self._maps.get(path)
+            if mapped is not None:
+                self._maps.move_to_end(path)
+        if mapped is None:
+            try:
+                with open(path, "rb") as file:
+                    if not os.fstat(file.fileno()).st_size:
+                        return b""
+                    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                return None
+            with self._lock:
+                self._maps[path] = mapped
+                # dropped mappings are unmapped once no request uses them
+                while len(self._maps) > MAPPED_PAYLOADS:
+                    self._maps.popitem(last=False)
+        return mapped
+
+    @contextmanager
+    def _exclusive(self, key: Hashable):
+        """Hold lock of key shared with other processes"""
+        if fcntl is None:
+            yield None
+            return None
+        digest = blake2b(repr(key).encode("utf-8"), digest_size=8).digest()
+        stripe = int.from_bytes(digest, "little") % LOCK_STRIPES
+        path = os.path.join(self.directory, f"stripe-{stripe:02d}.lock")
+        with open(path, "wb") as file:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield file
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+    def get(self, key: Hashable) -> Any:
+        """Get payload stored for given key
+
+        Args:
+            key (hashable): payload identity
+
+        Returns:
+            bytes-like or None: read-only mapping of payload, None if not cached
+        """
+        value = self._load(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if self.observer is not None:
+            self.observer(value is not None)
+        return value
+
+    def put(self, key: Hashable, value: bytes) -> None:
+        """Publish payload, file is written under temporary
+        name and renamed, so readers never see it incomplete,
+        payloads bigger than whole budget are not stored
+
+        Args:
+            key (hashable): payload identity
+            value (bytes): payload
+        """
+        if len(value) > self.maxsize:
+            return None
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(handle, "wb") as file:
+                file.write(value)
+            os.replace(temporary, self._path(key))
+        except BaseException:
+            os.remove(temporary)
+            raise
+        with self._lock:
+            self.size += len(value)
+            full = self.size > self.maxsize
+        if full:
+            self._evict()
+
+    def fetch(self, key: Hashable, factory: Callable) -> bytes:
+        """Get payload stored for given key, on miss payload is
+        made by factory in one process while others wait for it
+
+        Args:
+            key (hashable): payload identity
+            factory (callable): returns payload and bool telling
+                                if it can be stored under key
+
+        Returns:
+            bytes-like: payload
+        """
+        value = self.get(key)
+        if value is None:
+            with self._exclusive(key):
+                # other process could have made it meanwhile
+                value = self._load(key)
+                if value is None:
+                    value, keep = factory()
+                    if keep:
+                        self.put(key, value)
+        return value
+
+    def resize(self, maxsize: int) -> None:
+        """Change memory budget, removes payloads if needed
+
+        Args:
+            maxsize (int): new memory budget in bytes
+        """
+        if maxsize == self.maxsize:
+            return None
+        self.maxsize = maxsize
+        self._evict()
+
+    def clear(self) -> None:
+        """Remove all published payloads"""
+        with self._lock:
+            self._maps.clear()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".payload"):
+                self._remove(entry.path)
+        self.size = 0
+
+    def _evict(self) -> None:
+        """Remove oldest payloads until memory budget is met"""
+        payloads = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".payload"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                payloads.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        payloads.sort()
+        size = sum(length for _, length, _ in payloads)
+        for _, length, path in payloads:
+            if size <= self.maxsize:
+                break
+            self._remove(path)
+            size -= length
+        self.size = size
+
+    def _remove(self, path: str) -> None:
+        # processes still mapping it keep their copy until they drop it
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,99 @@
+# -*- encoding: utf-8 -*-
+import lzma
+import zlib
+from typing import Iterable
+
+# supported methods, in order of client preference
+METHODS = ("zlib", "lzma")
+
+
+def negotiate(header: str, method: str) -> str:
+    """Choose compression method for response
+
+    Args:
+        header (str): comma separated methods accepted by client
+        method (str): method configured on server, empty to disable
+
+    Returns:
+        str or None: method to use, None if no compression
+    """
+    accepted = [value.strip() for value in (header or "").split(",")]
+    return method if method in METHODS and method in accepted else None
+
+
+def compressor(method: str, level: int = 6):
+    """Create streaming compressor object
+
+    Args:
+        method (str): one of METHODS
+        level (int, optional): compression level 0-9. Defaults to 6.
+
+    Raises:
+        ValueError: if method is not supported
+
+    Returns:
+        object: compressor with compress() and flush() methods
+    """
+    if method == "zlib":
+        return zlib.compressobj(level)
+    if method == "lzma":
+        return lzma.LZMACompressor(preset=level)
+    raise ValueError(f"Unsupported compression: {method!r}")
+
+
+def compress(data: bytes, method: str, level: int = 6) -> bytes:
+    """Compress whole buffer
+
+    Args:
+        data (bytes): data to compress
+        method (str): one of METHODS
+        level (int, optional): compression level 0-9. Defaults to 6.
+
+    Returns:
+        bytes: compressed data
+    """
+    worker = compressor(method, level)
+    return worker.compress(data) + worker.flush()
+
+
+def decompressChunks(chunks: Iterable[bytes], method: str):
+    """Decompress stream of chunks
+
+    Args:
+        chunks (iterable): compressed chunks
+        method (str): one of METHODS
+
+    Raises:
+        ValueError: if method is not supported or data is corrupted
+
+    Yields:
+        bytes: decompressed piece
+    """
+    if method == "zlib":
+        worker = zlib.decompressobj()
+    elif method == "lzma":
+        worker = lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"Unsupported compression: {method!r}")
+    try:
+        for chunk in chunks:
+            piece = worker.decompress(chunk)
+            if piece:
+                yield piece
+        if method == "zlib":
+            yield worker.flush()
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ValueError("Corrupted compressed data.") from e
+
+
+def decompress(data: bytes, method: str) -> bytes:
+    """Decompress whole buffer
+
+    Args:
+        data (bytes): compressed data
+        method (str): one of METHODS
+
+    Returns:
+        bytes: decompressed data
+    """
+    return b"".join(decompressChunks((data,), method))
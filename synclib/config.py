@@ -1,6 +1,10 @@
 import json
+import logging
 import os
-from typing import Any
+import time
+from threading import Lock
+from types import MappingProxyType
+from typing import Any, Mapping, Type
 
 
 class CFG:
@@ -74,6 +78,18 @@ class ServerCFG(CFG):
         "allow_edit": False,
         "encode": True,
         "encode_key": "",
+        "cache_size": 67108864,
+        "chunk_size": 65536,
+        "watch_timeout": 30.0,
+        "watch_interval": 0.1,
+        "threads": 16,
+        "reload_interval": 1.0,
+        "manifest_interval": 1.0,
+        "compression": "zlib",
+        "compression_level": 6,
+        "server": "waitress",
+        "workers": 1,
+        "metrics": True,
     }
 
 
@@ -87,4 +103,87 @@ class ClientCFG(CFG):
         "allow_edit": False,
         "address": "",
         "port": "8080",
-    }
\ No newline at end of file
+        "delta": True,
+        "watch": True,
+        "watch_timeout": 25.0,
+        "pool_size": 4,
+        "timeout": 10.0,
+        "chunk_size": 65536,
+        "directory": False,
+        "compression": True,
+        "fsync": False,
+        "history": "",
+        "adaptive": True,
+        "min_interval": 0.1,
+        "max_interval": 10.0,
+    }
+
+
+class CachedCFG:
+    """Keeps config loaded in memory and provides immutable
+    snapshots of it, file is reloaded when its mtime changes"""
+
+    def __init__(self, cfgClass: Type[CFG], path: str = "./.cfg") -> None:
+        """Set config class and path, config is loaded
+        with first call to get()
+
+        Args:
+            cfgClass (type): CFG subclass providing defaults
+            path (str, optional): path to config file. Defaults to "./.cfg".
+        """
+        self.cfgClass = cfgClass
+        self.path = path
+        self._snapshot = None
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = Lock()
+
+    def get(self) -> Mapping[str, Any]:
+        """Get current config snapshot, file mtime is checked
+        at most once per reload_interval seconds
+
+        Returns:
+            Mapping: read only config with defaults filled in
+        """
+        snapshot = self._snapshot
+        if (
+            snapshot is not None
+            and time.monotonic() - self._checked < snapshot["reload_interval"]
+        ):
+            return snapshot
+        with self._lock:
+            if self._snapshot is None:
+                # first load, CFG creates missing or broken file
+                self._snapshot = self._freeze(self.cfgClass(self.path)._config)
+                self._mtime = self._getMtime()
+            elif time.monotonic() - self._checked >= self._snapshot["reload_interval"]:
+                mtime = self._getMtime()
+                if mtime != self._mtime:
+                    self._reload(mtime)
+            self._checked = time.monotonic()
+            return self._snapshot
+
+    def invalidate(self) -> None:
+        """Force mtime check on next get(), safe to call from signal handler"""
+        self._checked = 0.0
+        self._mtime = None
+
+    def _reload(self, mtime: int) -> None:
+        """Load config file, previous snapshot is kept if file
+        can't be parsed (ie. it is being written right now)
+        """
+        try:
+            with open(self.path) as file:
+                self._snapshot = self._freeze(json.load(file))
+            self._mtime = mtime
+        except Exception as e:
+            logging.warning(f"Config reload failed, keeping previous one: {e}")
+
+    def _getMtime(self) -> int:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _freeze(self, config: dict) -> Mapping[str, Any]:
+        return MappingProxyType({**self.cfgClass.DEFAULT_CONFIG, **config})
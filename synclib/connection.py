@@ -0,0 +1,68 @@
+# -*- encoding: utf-8 -*-
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Connection:
+    """
+    Keep-alive HTTP session bound to single server,
+    pooled connections are reused by every request
+    """
+
+    def __init__(
+        self,
+        address: str,
+        port: str,
+        poolSize: int = 4,
+        timeout: float = 10.0,
+        headers: dict = None,
+    ) -> None:
+        """Create session and precompute base url of server
+
+        Args:
+            address (str): server address
+            port (str): server port, empty for default
+            poolSize (int, optional): max number of kept connections. Defaults to 4.
+            timeout (float, optional): default request timeout in seconds. Defaults to 10.0.
+            headers (dict, optional): headers sent with every request. Defaults to None.
+        """
+        self.baseUrl = f"http://{address}{':'+port if port else ''}"
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        self.session.mount(
+            "http://", HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+        )
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """Send request to server, kwargs are passed
+        to requests.Session.request
+
+        Args:
+            method (str): HTTP method
+            path (str): url path to resource
+
+        Returns:
+            requests.Response: server response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, self.baseUrl + path, **kwargs)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request("PUT", path, **kwargs)
+
+    def close(self) -> None:
+        """Close all pooled connections"""
+        self.session.close()
+
+    def __enter__(self) -> "Connection":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -1,15 +1,83 @@
 # -*- encoding: utf-8 -*-
-from threading import Thread, Event
+from threading import Thread, Event, Condition, Lock, current_thread
+from functools import partial
+from queue import Queue
+import heapq
+import itertools
+import random
 import sys
 import time
 import logging
-from typing import Callable, Tuple, Union
+from typing import Callable, Tuple, Type, Union
+
+from synclib.backoff import Backoff
 
 
 class DaemonLeaveException(Exception):
     pass
 
 
+class Scheduler:
+    """
+    Runs jobs at given time on small pool of shared worker
+    threads, jobs wait for their time on single timer heap,
+    threads are started on first scheduled job
+    """
+
+    def __init__(self, workers: int = 4) -> None:
+        """
+        Args:
+            workers (int, optional): number of worker threads. Defaults to 4.
+        """
+        self.workers = workers
+        # (time, sequence, job), sequence keeps order of equal times
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = Condition()
+        self._jobs = Queue()
+        self._threads = []
+
+    def schedule(self, when: float, job: Callable) -> None:
+        """Run job on one of workers once time.monotonic() reaches when
+
+        Args:
+            when (float): time.monotonic() value to run job at
+            job (callable): function without arguments
+        """
+        with self._condition:
+            if not self._threads:
+                self._threads.append(Thread(target=self.__timer__, daemon=True))
+                for _ in range(self.workers):
+                    self._threads.append(Thread(target=self.__worker__, daemon=True))
+                for thread in self._threads:
+                    thread.start()
+            heapq.heappush(self._heap, (when, next(self._sequence), job))
+            self._condition.notify()
+
+    def __timer__(self):
+        """Move jobs which are due from heap to worker queue"""
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                _, _, job = heapq.heappop(self._heap)
+            self._jobs.put(job)
+
+    def __worker__(self):
+        """Run jobs from worker queue"""
+        while True:
+            job = self._jobs.get()
+            try:
+                job()
+            except Exception as e:
+                logging.exception(e, exc_info=True)
+
+
+# scheduler used by daemons which don't get their own
+SCHEDULER = Scheduler()
+
+
 class Daemon:
     def __init__(
         self,
@@ -17,64 +85,124 @@ class Daemon:
         *,
         delay: float = 1.0,
         repeat: int = -1,
+        jitter: float = 0.0,
+        backoff: Backoff = None,
+        retry: Tuple[Type[Exception]] = (),
         tasks: Tuple[Callable] = None,
         callbacks: Tuple[Callable] = None,
+        scheduler: Scheduler = None,
     ):
         """Daemon class which can be used as a descriptor both as a class and as intance
-        to simply create thread daemon function(s) to be executed in single or multiple
-        times, with callback after termination
+        to simply create daemon function(s) to be executed in single or multiple
+        times, with callback after termination, tasks of all daemons run on
+        worker threads of shared Scheduler
 
         Args:
             task (callable, optional): first task to be added to task list, can be passed in call. Defaults to None.
             delay (float, optional): delay between each execution of task. Defaults to 1.0.
             repeat (int, optional): defines how many times to repeat task loop, -1 means infinitely. Defaults to -1.
+            jitter (float, optional): max random deviation of delay, as fraction of delay,
+                                    keeps daemons with same delay from firing together. Defaults to 0.0.
+            backoff (Backoff, optional): adaptive interval used instead of delay, pass counts
+                                    as change if any task returns truthy value. Defaults to None.
+            retry (tuple, optional): exceptions which don't end task loop, pass is retried
+                                    after delay (or backoff failure interval). Defaults to ().
             tasks (tuple or list, optional): tasks to extend task list (repeat periodically)
             callbacks (tuple or list, optional): callbacks to extend callbacks list (execute after termination of task loop)
+            scheduler (Scheduler, optional): scheduler running tasks. Defaults to SCHEDULER.
         """
         self._repeat = repeat
         self._delay = delay
+        self._jitter = jitter
+        self._backoff = backoff
+        self._retry = tuple(retry)
         self._tasks = []
         self._callbacks = []
-        self._thread = None
+        self._scheduler = scheduler or SCHEDULER
         self._dieFlag = Event()
+        # set whenever task loop isn't running
+        self._done = Event()
+        self._done.set()
+        self._lock = Lock()
+        # bumped to invalidate already scheduled run
+        self._generation = 0
+        self._running = False
+        self._worker = None
+        self._repeatCount = 0
+        self._arguments = None
+        # unexpected exception which ended last task loop
+        self.lastError = None
         #self._tasks.append(func) if callable(func) else None
         self._tasks.append(tasks) if isinstance(tasks, (tuple, list)) else None
         self._callbacks.append(callbacks) if isinstance(callbacks, (tuple, list)) else None
 
-    def __daemon__(self, *args, **kwargs):
-        """Daemon tasks loop, with checking for termination flag
+    def __daemon__(self, generation: int):
+        """Single pass of task loop, run on scheduler worker,
+        schedules next pass or calls callbacks if termination
+        flag is set or repeat count is exhausted
 
-        Raises:
-            DaemonLeaveException: Raised to leave a loop, shouldn't ever leave this function
+        Args:
+            generation (int): generation pass was scheduled in, stale passes are dropped
         """
+        with self._lock:
+            if generation != self._generation:
+                return None
+            self._running = True
+            self._worker = current_thread()
+        args, kwargs = self._arguments
+        # get start time of execution, to calc how to wait then
+        startTime = time.monotonic()
+        backoff = self._backoff
         try:
-            repeatCount = self._repeat
-            delta = 0
-            while True:
-                # first condition is used to wait for delta seconds and terminate on signal
-                # second one makes daemon leave after n repetitions
-                if self._dieFlag.wait(delta) or repeatCount == 0:
-                    raise DaemonLeaveException()
+            if not self._dieFlag.is_set() and self._repeatCount != 0:
                 # decement repeat count, leave it as is if -1 -> infinite execution
-                repeatCount = repeatCount - 1 if repeatCount > 0 else repeatCount
-                # get start time of execution, to calc how to wait then
-                startTime = time.time()
-                # loop through all callbacks
+                self._repeatCount -= 1 if self._repeatCount > 0 else 0
+                changed = False
                 for func in self._tasks:
                     # before execution test if exit flag is set
-                    if self._dieFlag.isSet():
-                        raise DaemonLeaveException()
-                    func(*args, **kwargs)
-                # calculate how long to wait before next execution
-                delta = startTime + self._delay - time.time()
-                delta = delta if delta > 0 else 0
-        except DaemonLeaveException:
-            # this exception is just a signl to end
-            for callback in self._callbacks:
-                callback(*args, **kwargs)
+                    if self._dieFlag.is_set():
+                        break
+                    changed = bool(func(*args, **kwargs)) or changed
+                if backoff is not None:
+                    backoff.changed() if changed else backoff.idle()
+        except self._retry as e:
+            logging.warning(f"Daemon task failed, retrying: {e!r}")
+            if backoff is not None:
+                backoff.failed()
         except Exception as e:
-            # log exeption if unusual
+            # log exeption if unusual, callbacks are skipped
             logging.exception(e, exc_info=True)
+            self.lastError = e
+            self._finish()
+            return None
+        with self._lock:
+            if not self._dieFlag.is_set() and self._repeatCount != 0:
+                self._running = False
+                self._worker = None
+                self._scheduler.schedule(
+                    startTime + self._nextDelay(), partial(self.__daemon__, generation)
+                )
+                return None
+        try:
+            for callback in self._callbacks:
+                callback(*args, **kwargs)
+        finally:
+            self._finish()
+
+    def _nextDelay(self) -> float:
+        """Delay before next pass, with jitter applied"""
+        delay = self.interval
+        if self._jitter:
+            return max(0, delay * (1 + random.uniform(-self._jitter, self._jitter)))
+        return delay
+
+    def _finish(self):
+        """Mark task loop as terminated"""
+        with self._lock:
+            self._running = False
+            self._worker = None
+            self._arguments = None
+            self._done.set()
 
     def __call__(self, *args, **kwargs):
         """If instance of Daemon is used as descriptor
@@ -82,12 +210,12 @@ class Daemon:
         first execution of this fuction is expecting
         a callable to be passed as argument,
         Every next call and every call if Daemon class
-        was used as descriptor will run daemon tasks thread
-        if there is no already running
+        was used as descriptor will schedule daemon tasks
+        if they are not already running
 
         Raises:
             ValueError: if there is no callable to execute
-            RuntimeError: if there is already a running thread
+            RuntimeError: if task loop is already running
 
         Returns:
             self: this instance of daemon
@@ -98,28 +226,20 @@ class Daemon:
             else:
                 raise ValueError("Missing callable.")
         else:
-            if self._thread is None:
-                self._setThread(args, kwargs)
-                self._thread.start()
-            else:
-                raise RuntimeError("Thread is already alive!")
+            with self._lock:
+                if not self._done.is_set():
+                    raise RuntimeError("Daemon is already running!")
+                self._done.clear()
+                self._dieFlag.clear()
+                self._repeatCount = self._repeat
+                self._arguments = (args, kwargs)
+                self.lastError = None
+                self._generation += 1
+                # first pass is shifted by jitter too
+                when = time.monotonic() + random.uniform(0, self._jitter * self._delay)
+                self._scheduler.schedule(when, partial(self.__daemon__, self._generation))
         return self
 
-    def _setThread(self, args, kwargs):
-        """Set self._thread to new thread object
-        args and kwargs will be passed to it
-
-        Args:
-            args (tuple): args to be passed to thread
-            kwargs (dict): kwargs to be passed to thread
-        """
-        if self._thread is None:
-            self._thread = Thread(
-                target=self.__daemon__, args=args, kwargs=kwargs, daemon=True
-            )
-        else:
-            raise RuntimeError("Thread cannot be overwriten")
-
     def __iadd__(self, other: Union[Callable, "Daemon"]):
         """Add callable to tasks or extend tasks by
         tasks from another Daemon
@@ -145,6 +265,31 @@ class Daemon:
         else:
             self._delay = value
 
+    @property
+    def backoff(self):
+        return self._backoff
+
+    @backoff.setter
+    def backoff(self, value):
+        if value is not None and not isinstance(value, Backoff):
+            raise TypeError(f"Invalid backoff value type: {type(value)}")
+        else:
+            self._backoff = value
+
+    @property
+    def retry(self):
+        return self._retry
+
+    @retry.setter
+    def retry(self, value):
+        self._retry = tuple(value)
+
+    @property
+    def interval(self):
+        """Effective delay before next pass, without jitter"""
+        backoff = self._backoff
+        return self._delay if backoff is None else backoff.interval
+
     def addCallback(self, func: Callable):
         """Insert callback into callback list,
         it will be called after task loop finishes,
@@ -169,12 +314,21 @@ class Daemon:
         self._tasks.append(func)
 
     def kill(self, wait: bool = True):
-        """Set termination flag for thread, and wait until it terminates"""
-        self._dieFlag.set()
-        while self._thread.isAlive() and wait:
-            time.sleep(0.01)
-        self._dieFlag.clear()
-        self._thread = None
+        """Set termination flag for task loop, and wait until it terminates,
+        waiting is skipped when called from inside of task or callback"""
+        with self._lock:
+            if self._done.is_set():
+                return None
+            self._dieFlag.set()
+            if not self._running:
+                # drop scheduled pass and terminate right away
+                self._generation += 1
+                self._scheduler.schedule(
+                    time.monotonic(), partial(self.__daemon__, self._generation)
+                )
+            worker = self._worker
+        if wait and worker is not current_thread():
+            self._done.wait()
 
     def getTasks(self):
         """Retrive list of tasks provided for this daemon
@@ -185,10 +339,9 @@ class Daemon:
         return self._tasks
 
     def isAlive(self):
-        """Returns wheater thread exists and is alive,
-        true if both, false otherise
+        """Returns wheater task loop is running
 
         Returns:
             bool: True if alive, false otherwise
         """
-        return self._thread is not None and self._thread.is_alive()
+        return not self._done.is_set()
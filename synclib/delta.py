@@ -0,0 +1,299 @@
+# -*- encoding: utf-8 -*-
+from bisect import bisect_left
+from hashlib import blake2b
+import struct
+import zlib
+from typing import Dict, List, Tuple
+from synclib.encryption import loadNumpy
+
+# modulus of adler32 checksum
+ADLER_MOD = 65521
+# size of strong hash of single block
+STRONG_SIZE = 16
+# window positions checksummed at once by numpy scan
+SCAN_BLOCK = 262144
+# size of bitmap prefiltering weak checksums, power of two
+SCAN_FILTER = 1048576
+# instruction stream opcodes
+OP_COPY = b"C"
+OP_LITERAL = b"L"
+OP_END = b"E"
+
+_BLOCK = struct.Struct(">I16s")
+_HEADER = struct.Struct(">I")
+_COPY = struct.Struct(">II")
+_LITERAL = struct.Struct(">I")
+_END = struct.Struct(">Q16s")
+
+
+def strongHash(data: bytes) -> bytes:
+    """Strong hash used to confirm block matches
+
+    Args:
+        data (bytes): block content
+
+    Returns:
+        bytes: STRONG_SIZE bytes long digest
+    """
+    return blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+def blockSizeFor(length: int) -> int:
+    """Choose block size for file of given length,
+    square root of length keeps both signature and
+    delta overhead small
+
+    Args:
+        length (int): length of file in bytes
+
+    Returns:
+        int: block size, power of two in range <512, 65536>
+    """
+    size = 512
+    while size < 65536 and size * size < length:
+        size *= 2
+    return size
+
+
+def makeSignature(data: bytes, blockSize: int = None) -> bytes:
+    """Compute signature of data, made of weak (adler32)
+    and strong checksum of each full block
+
+    Args:
+        data (bytes): content of local file
+        blockSize (int, optional): block size, chosen by
+                                blockSizeFor() if not given. Defaults to None.
+
+    Returns:
+        bytes: encoded signature
+    """
+    blockSize = blockSize or blockSizeFor(len(data))
+    output = [_HEADER.pack(blockSize)]
+    view = memoryview(data)
+    for start in range(0, len(data) - blockSize + 1, blockSize):
+        block = view[start : start + blockSize]
+        output.append(_BLOCK.pack(zlib.adler32(block), strongHash(block)))
+    return b"".join(output)
+
+
+def loadSignature(signature: bytes) -> Tuple[int, List[Tuple[int, bytes]]]:
+    """Decode signature created with makeSignature()
+
+    Args:
+        signature (bytes): encoded signature
+
+    Raises:
+        ValueError: if signature is malformed
+
+    Returns:
+        tuple: block size and list of (weak, strong) checksums
+    """
+    if len(signature) < _HEADER.size or (len(signature) - _HEADER.size) % _BLOCK.size:
+        raise ValueError("Malformed signature.")
+    (blockSize,) = _HEADER.unpack_from(signature)
+    if blockSize == 0:
+        raise ValueError("Malformed signature.")
+    blocks = [
+        _BLOCK.unpack_from(signature, offset)
+        for offset in range(_HEADER.size, len(signature), _BLOCK.size)
+    ]
+    return blockSize, blocks
+
+
+def _candidates(data, blockSize: int, weaks) -> List[int]:
+    """Find offsets of windows whose weak checksum (adler32)
+    is one of given, computed for all windows at once
+
+    Args:
+        data (bytes-like): content to scan
+        blockSize (int): size of window
+        weaks (iterable): weak checksums of wanted blocks
+
+    Returns:
+        list or None: ascending offsets, None if numpy isn't
+                    installed and checksum has to be rolled
+    """
+    numpy = loadNumpy()
+    if numpy is None:
+        return None
+    array = numpy.frombuffer(data, dtype=numpy.uint8)
+    keys = numpy.array(sorted(weaks), dtype=numpy.int64)
+    # cheap filter by low bits of checksum, exact keys are only
+    # searched for windows passing it
+    known = numpy.zeros(SCAN_FILTER, dtype=numpy.bool_)
+    known[keys & (SCAN_FILTER - 1)] = True
+    found = []
+    for base in range(0, len(array) - blockSize + 1, SCAN_BLOCK):
+        block = array[base : base + SCAN_BLOCK + blockSize - 1].astype(numpy.int64)
+        count = len(block) - blockSize + 1
+        # sums[k] is sum of first k bytes, weighted[k] of
+        # first k bytes multiplied by their index in block
+        sums = numpy.zeros(len(block) + 1, dtype=numpy.int64)
+        numpy.cumsum(block, out=sums[1:])
+        weighted = numpy.zeros(len(block) + 1, dtype=numpy.int64)
+        numpy.cumsum(block * numpy.arange(len(block)), out=weighted[1:])
+        total = sums[blockSize:] - sums[:count]
+        # sum of bytes multiplied by their distance from window end
+        distance = (numpy.arange(count) + blockSize) * total - (
+            weighted[blockSize:] - weighted[:count]
+        )
+        a = (1 + total) % ADLER_MOD
+        b = (blockSize + distance) % ADLER_MOD
+        hashes = (b << 16) | a
+        offsets = numpy.flatnonzero(known[hashes & (SCAN_FILTER - 1)])
+        hashes = hashes[offsets]
+        index = numpy.minimum(numpy.searchsorted(keys, hashes), len(keys) - 1)
+        found.extend((offsets[keys[index] == hashes] + base).tolist())
+    return found
+
+
+def makeDelta(data: bytes, signature: bytes, maxLiteral: int = None) -> bytes:
+    """Compute instruction stream which rebuilds data from
+    file described by signature, blocks found in that file
+    are referenced by index, everything else is sent as literal
+
+    Args:
+        data (bytes): current content of file
+        signature (bytes): signature of outdated file
+        maxLiteral (int, optional): give up once more literal bytes
+                                    are found, rolling checksum costs
+                                    a step per unmatched byte. Defaults to None.
+
+    Raises:
+        ValueError: if signature is malformed
+
+    Returns:
+        bytes or None: encoded instruction stream, None if
+                    it would hold more than maxLiteral literal bytes
+    """
+    blockSize, blocks = loadSignature(signature)
+    table: Dict[int, List[Tuple[int, bytes]]] = {}
+    for index, (weak, strong) in enumerate(blocks):
+        table.setdefault(weak, []).append((index, strong))
+    output = [_HEADER.pack(blockSize)]
+    view = memoryview(data)
+    length = len(data)
+    # first block and count of pending copy instruction
+    pending = [0, 0]
+    literalStart = 0
+    # literal bytes before literalStart
+    literal = [0]
+    if maxLiteral is None:
+        maxLiteral = length
+
+    def flushCopy():
+        if pending[1]:
+            output.append(OP_COPY + _COPY.pack(*pending))
+            pending[1] = 0
+
+    def flushLiteral(end):
+        if end > literalStart:
+            flushCopy()
+            output.append(OP_LITERAL + _LITERAL.pack(end - literalStart))
+            output.append(view[literalStart:end])
+            literal[0] += end - literalStart
+
+    # without numpy every byte rolls checksum in python,
+    # with it loop only visits windows with known checksum
+    candidates = _candidates(data, blockSize, table) if table else None
+    cursor = 0
+    position = 0
+    weak = None
+    while table and position + blockSize <= length:
+        if candidates is not None:
+            cursor = bisect_left(candidates, position, cursor)
+            following = candidates[cursor] if cursor < len(candidates) else length
+            if following > position:
+                # windows between can't match, they are literal
+                if literal[0] + following - literalStart > maxLiteral:
+                    return None
+                position = following
+                weak = None
+                continue
+        if weak is None:
+            weak = zlib.adler32(view[position : position + blockSize])
+        match = None
+        for index, strong in table.get(weak, ()):
+            if strongHash(view[position : position + blockSize]) == strong:
+                match = index
+                break
+        if match is not None:
+            flushLiteral(position)
+            # merge consecutive blocks into single copy instruction
+            if pending[1] and pending[0] + pending[1] == match:
+                pending[1] += 1
+            else:
+                flushCopy()
+                pending[:] = [match, 1]
+            position += blockSize
+            literalStart = position
+            weak = None
+            continue
+        if literal[0] + position - literalStart > maxLiteral:
+            return None
+        if candidates is not None:
+            weak = None
+        # roll adler32 one byte forward
+        elif position + blockSize < length:
+            old, new = data[position], data[position + blockSize]
+            a = ((weak & 0xFFFF) - old + new) % ADLER_MOD
+            b = ((weak >> 16) - blockSize * old + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+        position += 1
+    flushLiteral(length)
+    if literal[0] > maxLiteral:
+        return None
+    flushCopy()
+    output.append(OP_END + _END.pack(length, strongHash(data)))
+    return b"".join(output)
+
+
+def applyDelta(base: bytes, delta: bytes) -> bytes:
+    """Rebuild current file from outdated base and
+    instruction stream created with makeDelta()
+
+    Args:
+        base (bytes): content of outdated file, the one signature was made of
+        delta (bytes): encoded instruction stream
+
+    Raises:
+        ValueError: if stream is malformed or result doesn't match
+                    length and hash sent by server
+
+    Returns:
+        bytes: current content of file
+    """
+    view = memoryview(delta)
+    baseView = memoryview(base)
+    output = bytearray()
+    try:
+        (blockSize,) = _HEADER.unpack_from(delta)
+        position = _HEADER.size
+        while True:
+            opcode = delta[position : position + 1]
+            position += 1
+            if opcode == OP_COPY:
+                start, count = _COPY.unpack_from(delta, position)
+                position += _COPY.size
+                begin = start * blockSize
+                end = begin + count * blockSize
+                if end > len(base):
+                    raise ValueError("Copy instruction outside of base.")
+                output += baseView[begin:end]
+            elif opcode == OP_LITERAL:
+                (size,) = _LITERAL.unpack_from(delta, position)
+                position += _LITERAL.size
+                if position + size > len(delta):
+                    raise ValueError("Truncated literal.")
+                output += view[position : position + size]
+                position += size
+            elif opcode == OP_END:
+                length, digest = _END.unpack_from(delta, position)
+                break
+            else:
+                raise ValueError(f"Unknown instruction: {opcode!r}")
+    except struct.error as e:
+        raise ValueError("Truncated instruction stream.") from e
+    if len(output) != length or strongHash(output) != digest:
+        raise ValueError("Rebuilt data doesn't match server version.")
+    return bytes(output)
@@ -1,9 +1,45 @@
 # -*- encoding: utf-8 -*-
 #%%
 from random import randint
+from collections import OrderedDict
+from threading import Lock
 import math
+import time
 from typing import Union
 
+# numpy is imported with first derived key, importing it is slow
+# and not needed at all if encoding is off, see loadNumpy()
+numpy = None
+_numpyLoaded = False
+
+# translation tables moving every byte value forward by delta,
+# _SHIFT_TABLES[delta] maps byte -> (byte + delta) % 256
+_SHIFT_TABLES = [bytes((i + delta) % 256 for i in range(256)) for delta in range(256)]
+# approximate size of pre-tiled keystream block, in bytes
+KEYSTREAM_BLOCK_SIZE = 65536
+# how many derived keys are kept in process-wide cache
+KEYSTREAM_CACHE_SIZE = 64
+# called with seconds spent in each bulk operation, None to skip timing
+OBSERVER = None
+
+
+def loadNumpy():
+    """Import numpy on first call
+
+    Returns:
+        module or None: numpy, None if it isn't installed and
+                        bulk engine falls back to pure python
+                        bytes.translate path
+    """
+    global numpy, _numpyLoaded
+    if not _numpyLoaded:
+        try:
+            import numpy
+        except ImportError:
+            pass
+        _numpyLoaded = True
+    return numpy
+
 
 class EncryptionKey:
     """
@@ -78,6 +114,15 @@ class EncryptionKey:
         """Reset iterator key index"""
         self.key_index = 0
 
+    def seek(self, offset: int) -> None:
+        """Set key index so that next() returns key byte
+        for data byte at given offset of the stream
+
+        Args:
+            offset (int): position in data stream
+        """
+        self.key_index = offset % len(self.enc_key) if self.enc_key else 0
+
     @staticmethod
     def getNewKey(length: int = 16) -> str:
         """Function for generating new random key
@@ -91,16 +136,220 @@ class EncryptionKey:
             str: new string key
         """
         key = ""
-        for _ in range(16):
+        for _ in range(length):
             key += chr(randint(33, 127))
         return key
 
 
+class Keystream:
+    """
+    Derived EncryptionKey prepared for bulk
+    application to whole buffers
+    """
+
+    def __init__(self, key: EncryptionKey, blockSize: int = KEYSTREAM_BLOCK_SIZE) -> None:
+        """Rotate enc_key so that it starts where EncryptionKey
+        iteration starts, then prepare translation tables
+        and tiled keystream block
+
+        Args:
+            key (EncryptionKey): derived key
+            blockSize (int, optional): approximate size of tiled block.
+                                    Defaults to KEYSTREAM_BLOCK_SIZE.
+        """
+        self.key = key
+        # EncryptionKey.next() increments index before reading
+        # so first data byte is paired with enc_key[1]
+        self.stream = key.enc_key[1:] + key.enc_key[:1]
+        self.length = len(self.stream)
+        # one translation table per key position
+        self.encryptTables = [_SHIFT_TABLES[delta] for delta in self.stream]
+        self.decryptTables = [_SHIFT_TABLES[-delta % 256] for delta in self.stream]
+        # block length is multiple of key length, so consecutive
+        # blocks stay aligned with keystream, one more key length
+        # is tiled to allow starting block at any keystream offset
+        self.block = None
+        self.blockLength = self.length * max(1, blockSize // self.length)
+        if loadNumpy() is not None:
+            self.block = numpy.resize(
+                numpy.frombuffer(self.stream, dtype=numpy.uint8),
+                self.blockLength + self.length,
+            )
+
+
+class KeystreamCache:
+    """
+    Thread safe LRU cache of Keystream
+    objects, keyed by raw key
+    """
+
+    def __init__(self, maxsize: int = KEYSTREAM_CACHE_SIZE) -> None:
+        """Create empty cache
+
+        Args:
+            maxsize (int, optional): max number of cached keys.
+                                    Defaults to KEYSTREAM_CACHE_SIZE.
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Union[str, bytes, EncryptionKey]) -> Keystream:
+        """Get Keystream for given key, derive it
+        if not present in cache
+
+        Args:
+            key (str, bytes or EncryptionKey): encoding key
+
+        Returns:
+            Keystream: prepared keystream
+        """
+        raw = key.raw_key if isinstance(key, EncryptionKey) else key
+        with self._lock:
+            keystream = self._entries.get(raw)
+            if keystream is not None:
+                self._entries.move_to_end(raw)
+                return keystream
+        # derive outside of lock, other threads shouldn't wait for it
+        keystream = Keystream(key if isinstance(key, EncryptionKey) else EncryptionKey(key))
+        with self._lock:
+            self._entries[raw] = keystream
+            self._entries.move_to_end(raw)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return keystream
+
+    def clear(self) -> None:
+        """Remove all cached keys"""
+        with self._lock:
+            self._entries.clear()
+
+
+# process-wide cache used by encryptBytes() and decryptBytes()
+KEYSTREAM_CACHE = KeystreamCache()
+
+
+def _shiftBytes(
+    data: bytes,
+    key: Union[str, bytes, EncryptionKey],
+    sign: int,
+    offset: int = 0,
+    out: bytearray = None,
+) -> bytes:
+    """_transform() timed for OBSERVER, if one is set"""
+    observer = OBSERVER
+    if observer is None:
+        return _transform(data, key, sign, offset, out)
+    start = time.perf_counter()
+    output = _transform(data, key, sign, offset, out)
+    observer(time.perf_counter() - start)
+    return output
+
+
+def _transform(
+    data: bytes,
+    key: Union[str, bytes, EncryptionKey],
+    sign: int,
+    offset: int = 0,
+    out: bytearray = None,
+) -> bytes:
+    """Move each byte of data by coresponding keystream byte
+    in one bulk step, keystream is enc_key tiled over data
+    starting at index 1, just as EncryptionKey iteration does
+
+    Args:
+        data (bytes): bytes-like object to transform
+        key (str, bytes or EncryptionKey): encoding key
+        sign (int): 1 to encrypt, -1 to decrypt
+        offset (int, optional): position of data in whole stream. Defaults to 0.
+        out (bytearray, optional): writable buffer of the same length as data,
+                                output is written into it instead of new
+                                byte string. Defaults to None.
+
+    Returns:
+        bytes: transformed byte string, out if it was given
+    """
+    keystream = KEYSTREAM_CACHE.get(key)
+    if not data:
+        return b"" if out is None else out
+    offset %= keystream.length
+    if keystream.block is not None:
+        array = numpy.frombuffer(data, dtype=numpy.uint8)
+        if out is None:
+            output = numpy.empty_like(array)
+        else:
+            output = numpy.frombuffer(out, dtype=numpy.uint8)
+        block = keystream.block[offset : offset + keystream.blockLength]
+        operation = numpy.add if sign > 0 else numpy.subtract
+        # uint8 arithmetic wraps around, which equals % 256
+        for start in range(0, len(array), len(block)):
+            chunk = array[start : start + len(block)]
+            operation(chunk, block[: len(chunk)], out=output[start : start + len(chunk)])
+        return output.tobytes() if out is None else out
+    data = bytes(data)
+    output = bytearray(len(data)) if out is None else out
+    tables = keystream.encryptTables if sign > 0 else keystream.decryptTables
+    length = keystream.length
+    # every length-th byte is moved by the same delta, so each
+    # of those slices can be translated at once
+    for index in range(min(length, len(data))):
+        table = tables[(index + offset) % length]
+        output[index::length] = data[index::length].translate(table)
+    return bytes(output) if out is None else out
+
+
+def encryptBytes(
+    data: bytes,
+    key: Union[str, bytes, EncryptionKey],
+    offset: int = 0,
+    out: bytearray = None,
+) -> bytes:
+    """Bulk version of encrypt(), works on whole buffer
+    and returns encoded bytes directly, offset allows to
+    continue keystream of previous chunk of the same stream
+
+    Args:
+        data (bytes): data to encode
+        key (str, bytes or EncryptionKey): encoding key
+        offset (int, optional): position of data in whole stream. Defaults to 0.
+        out (bytearray, optional): buffer of the same length as data to
+                                write output into. Defaults to None.
+
+    Returns:
+        bytes: encoded byte string, out if it was given
+    """
+    return _shiftBytes(data, key, 1, offset, out)
+
+
+def decryptBytes(
+    data: bytes,
+    key: Union[str, bytes, EncryptionKey],
+    offset: int = 0,
+    out: bytearray = None,
+) -> bytes:
+    """Bulk version of decrypt(), works on whole buffer
+    and returns decoded bytes directly, offset allows to
+    continue keystream of previous chunk of the same stream
+
+    Args:
+        data (bytes): data to decode
+        key (str, bytes or EncryptionKey): encoding key
+        offset (int, optional): position of data in whole stream. Defaults to 0.
+        out (bytearray, optional): buffer of the same length as data to
+                                write output into. Defaults to None.
+
+    Returns:
+        bytes: decoded byte string, out if it was given
+    """
+    return _shiftBytes(data, key, -1, offset, out)
+
+
 def encrypt(data: bytes, key: str) -> bytes:
     """Simple encryption of given byte string
     by simply moving forward each byte value
     by n, where n means value for coresponding
-    byte of key
+    byte of key. Kept for compatibility, yields
+    single bytes of encryptBytes() output
 
     Args:
         data (bytes): data to encode
@@ -109,18 +358,17 @@ def encrypt(data: bytes, key: str) -> bytes:
     Returns:
         bytes: encoded byte string
     """
-    key = EncryptionKey(key)
     assert isinstance(data, bytes)
-    for byte, delta in zip(data, key):
-        # for each byte in data and each byte in key
-        # modulo forces output byte to be in range 0-255
-        yield int.to_bytes((byte + delta) % 256, 1, "big")
+    output = encryptBytes(data, key)
+    for index in range(len(output)):
+        yield output[index : index + 1]
     return
 
 
 def decrypt(data: bytes, key: str) -> bytes:
     """Functon applies silmple decryption to given
-    byte string
+    byte string. Kept for compatibility, yields
+    single bytes of decryptBytes() output
 
     Args:
         data (bytes): data to decode
@@ -129,18 +377,16 @@ def decrypt(data: bytes, key: str) -> bytes:
     Returns:
         bytes: decoded output byte string
     """
-    key = EncryptionKey(key)
-    for byte, delta in zip(data, key):
-        # modulo forces output byte to be in range 0-255
-        yield int.to_bytes((byte - delta) % 256, 1, "big")
+    output = decryptBytes(data, key)
+    for index in range(len(output)):
+        yield output[index : index + 1]
     return
 
 
 if __name__ == "__main__":
     key = EncryptionKey(EncryptionKey.getNewKey())
-    data = b"".join(encrypt("hey", key))
+    data = encryptBytes(b"hey", key)
     print(data)
-    key.reset()
-    print(decrypt(data, key).decode("utf-8"))
+    print(decryptBytes(data, key).decode("utf-8"))
 
 # %%
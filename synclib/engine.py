@@ -0,0 +1,520 @@
+# -*- encoding: utf-8 -*-
+import json
+import logging
+import os
+import time
+from synclib.encryption import decryptBytes, encryptBytes
+import synclib.compression as compression
+import synclib.delta as delta
+from synclib.files import WriteTracker
+from synclib.backoff import Backoff
+from synclib.manifest import RECORD, ChunkReader, Manifest
+from synclib.daemon import Daemon
+from synclib.history import History
+from synclib.stats import TransferStats
+
+
+# state shared between consecutive pullFile calls
+pullState = {
+    "etag": None,
+    "signature": None,
+    "partial": None,
+    "manifest": None,
+    "tree": None,
+    "history": None,
+}
+# digests of last written local files, identical content isn't rewritten
+WRITES = WriteTracker()
+# adaptive interval of polling daemons and retry interval of watchFile
+POLLING = Backoff()
+WATCHING = Backoff(minimum=0)
+
+
+class FatalResponseCode(Exception):
+    def __init__(self, code):
+        self.code = code
+
+
+class UnwantedConnectionError(Exception):
+    pass
+
+
+# errors after which pulling daemons retry instead of ending,
+# network errors of requests are added by preparePulling(), so
+# requests isn't imported until connection is made, other
+# OSErrors (local disk) end pulling and are reported
+RETRY = (FatalResponseCode,)
+
+
+def send(
+    stats: TransferStats,
+    connection,
+    method: str,
+    path: str,
+    timed: bool = True,
+    **kwargs,
+):
+    """Send request through connection and record it in stats,
+    failed connections and error responses count as errors
+
+    Args:
+        stats (TransferStats): statistics of pulling session
+        connection (Connection): connection to server
+        method (str): HTTP method
+        path (str): url path to resource
+        timed (bool, optional): record latency, False for requests
+                                waiting on purpose. Defaults to True.
+
+    Returns:
+        requests.Response: server response
+    """
+    start = time.perf_counter()
+    try:
+        response = connection.request(method, path, **kwargs)
+    except OSError:
+        stats.error()
+        raise
+    stats.request(time.perf_counter() - start if timed else None)
+    if response.status_code >= 400:
+        stats.error()
+    return response
+
+
+def localSignature(path: str) -> bytes:
+    """Get block signature of local file, signature is
+    recomputed only when file changed since last call
+
+    Args:
+        path (str): path to local file
+
+    Returns:
+        bytes: encoded signature
+    """
+    stat = os.stat(path)
+    identity = (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if pullState["signature"] is None or pullState["signature"][0] != identity:
+        with open(path, "rb") as file:
+            pullState["signature"] = (identity, delta.makeSignature(file.read()))
+    return pullState["signature"][1]
+
+
+def pullDelta(stats, setup, connection, headers):
+    """Ask server for changes against local copy of file
+
+    Returns:
+        tuple: response and rebuilt file content, content is
+                None if server can't send delta or it doesn't apply
+    """
+    signature = localSignature(setup["target"])
+    if setup["encode"]:
+        signature = encryptBytes(signature, setup["encode_key"])
+    # 303 sends client to /getFile, which is done by caller
+    response = send(
+        stats,
+        connection,
+        "POST",
+        "/getDelta",
+        data=signature,
+        headers=headers,
+        allow_redirects=False,
+    )
+    if response.status_code != 200:
+        return response, None
+    instructions = response.content
+    stats.received(len(instructions))
+    if setup["encode"]:
+        instructions = decryptBytes(instructions, setup["encode_key"])
+    if "X-Compression" in response.headers:
+        instructions = compression.decompress(
+            instructions, response.headers["X-Compression"]
+        )
+    with open(setup["target"], "rb") as file:
+        base = file.read()
+    try:
+        return response, delta.applyDelta(base, instructions)
+    except ValueError:
+        # local file changed meanwhile or stream got corrupted
+        return response, None
+
+
+def downloadFile(stats, setup, connection, headers):
+    """Download whole file into temporary file next to target,
+    which is renamed to target when complete, partial download
+    left by interrupted call is resumed with Range request,
+    compressed payload is kept compressed in temporary file
+    (ranges refer to it) and inflated when complete
+
+    Returns:
+        requests.Response or None: response of server, None if
+                                file didn't change or download
+                                was interrupted
+    """
+    part = setup["target"] + ".part"
+    offset = 0
+    headers = dict(headers)
+    if pullState["partial"] and os.path.exists(part):
+        offset = os.path.getsize(part)
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = pullState["partial"]
+    received = 0
+    response = send(stats, connection, "GET", "/getFile", headers=headers, stream=True)
+    with response:
+        if response.status_code == 304:
+            # file didn't change since last pull
+            return None
+        if response.status_code not in (200, 206):
+            # ie. 416, partial file doesn't match server version
+            pullState["partial"] = None
+            return None
+        if response.status_code == 200:
+            offset = 0
+        pullState["partial"] = response.headers.get("ETag")
+        # if connection breaks, partial file is kept and resumed on retry
+        try:
+            with open(part, "ab" if offset else "wb") as file:
+                for chunk in response.iter_content(setup["chunk_size"]):
+                    received += len(chunk)
+                    if setup["encode"]:
+                        chunk = decryptBytes(chunk, setup["encode_key"], offset)
+                    file.write(chunk)
+                    offset += len(chunk)
+        finally:
+            stats.received(received)
+    pullState["partial"] = None
+    coding = response.headers.get("X-Compression")
+    if coding:
+        try:
+            with open(part, "rb") as source:
+                with open(part + ".inflate", "wb") as file:
+                    chunks = iter(lambda: source.read(setup["chunk_size"]), b"")
+                    for piece in compression.decompressChunks(chunks, coding):
+                        file.write(piece)
+        finally:
+            os.remove(part)
+        part = part + ".inflate"
+    WRITES.commit(part, setup["target"], fsync=setup["fsync"])
+    return response
+
+
+@Daemon(delay=0.5, jitter=0.1, retry=RETRY)
+def pullFile(stats, setup, connection):
+    """Pull current version of target, through delta if
+    enabled, returns True if new version was received
+    """
+    headers = {}
+    fileData = None
+    # ask only for changes if local copy of last version still exists
+    if os.path.exists(setup["target"]):
+        if pullState["etag"]:
+            headers["If-None-Match"] = pullState["etag"]
+        if setup["delta"]:
+            response, fileData = pullDelta(stats, setup, connection, headers)
+            if response.status_code == 304:
+                return False
+    if fileData is None:
+        # throws requests.exceptions.ConnectionError !!!
+        response = downloadFile(stats, setup, connection, headers)
+        if response is None:
+            return False
+    else:
+        WRITES.write(setup["target"], fileData, setup["fsync"])
+    pullState["etag"] = response.headers.get("ETag")
+    recordVersion(setup)
+    return True
+
+
+def recordVersion(setup) -> None:
+    """Add pulled target to history store, if one is configured,
+    failure to record doesn't stop pulling
+    """
+    if not setup["history"]:
+        return None
+    try:
+        if pullState["history"] is None or pullState["history"].directory != setup["history"]:
+            pullState["history"] = History(setup["history"], fsync=setup["fsync"])
+        pullState["history"].recordFile(setup["target"])
+    except (OSError, ValueError) as e:
+        logging.warning(f"Can't record version of {setup['target']}: {e!r}")
+
+
+@Daemon(delay=0, retry=RETRY)
+def watchFile(stats, setup, connection):
+    """Long polling variant of pullFile, waits on /watch
+    until server version differs from local one, then
+    pulls it, re-armed by daemon without delay
+    """
+    if pullState["etag"] and os.path.exists(setup["target"]):
+        response = send(
+            stats,
+            connection,
+            "GET",
+            "/watch",
+            timed=False,
+            params={"timeout": setup["watch_timeout"]},
+            headers={"If-None-Match": pullState["etag"]},
+            timeout=setup["watch_timeout"] + 10,
+        )
+        if "ETag" not in response.headers:
+            # server doesn't support /watch, fall back to polling
+            watchFile.delay = pullFile.delay
+            watchFile.backoff = pullFile.backoff
+        elif response.status_code == 304:
+            return False
+    changed = False
+    for task in pullFile.getTasks():
+        changed = bool(task(stats, setup, connection)) or changed
+    return changed
+
+
+def countChunks(chunks, counter: list):
+    """Pass chunks through, adding their length to counter[0]"""
+    for chunk in chunks:
+        counter[0] += len(chunk)
+        yield chunk
+
+
+def decryptChunks(chunks, key: str):
+    """Decrypt stream of chunks encrypted with single keystream
+
+    Args:
+        chunks (iterable): encrypted chunks
+        key (str): encoding key
+
+    Yields:
+        bytes: decrypted chunk
+    """
+    offset = 0
+    for chunk in chunks:
+        yield decryptBytes(chunk, key, offset)
+        offset += len(chunk)
+
+
+def receiveFiles(
+    local: Manifest, reader: ChunkReader, chunkSize: int, fsync: bool = False
+) -> None:
+    """Write files from batched stream into local tree, each
+    file is written to temporary file renamed when complete
+
+    Raises:
+        ValueError: if stream is truncated or contains invalid path
+    """
+    while True:
+        header = reader.read(RECORD.size)
+        if not header:
+            break
+        if len(header) < RECORD.size:
+            raise ValueError("Truncated batch.")
+        length, remaining = RECORD.unpack(header)
+        path = local.resolve(reader.read(length).decode("utf-8"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".part", "wb") as file:
+            while remaining:
+                chunk = reader.read(min(chunkSize, remaining))
+                if not chunk:
+                    raise ValueError("Truncated batch.")
+                file.write(chunk)
+                remaining -= len(chunk)
+        WRITES.commit(path + ".part", path, fsync=fsync)
+
+
+def removeFiles(local: Manifest, paths: list) -> None:
+    """Remove files deleted on server from local tree,
+    directories left empty are removed too
+    """
+    root = os.path.abspath(local.root)
+    for relpath in paths:
+        path = local.resolve(relpath)
+        WRITES.remove(path)
+        directory = os.path.dirname(os.path.abspath(path))
+        while directory != root:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # not empty
+                break
+            directory = os.path.dirname(directory)
+
+
+@Daemon(delay=0.5, jitter=0.1, retry=RETRY)
+def pullTree(stats, setup, connection):
+    """Pull directory tree, manifest of server tree is compared
+    with local one and only changed files are fetched, all
+    of them in single batched request, files removed on
+    server are removed locally
+    """
+    headers = {}
+    if pullState["manifest"]:
+        headers["If-None-Match"] = pullState["manifest"]
+    response = send(stats, connection, "GET", "/manifest", headers=headers)
+    if response.status_code == 304:
+        return False
+    if response.status_code != 200:
+        raise FatalResponseCode(response.status_code)
+    data = response.content
+    received = [len(data)]
+    if setup["encode"]:
+        data = decryptBytes(data, setup["encode_key"])
+    if "X-Compression" in response.headers:
+        data = compression.decompress(data, response.headers["X-Compression"])
+    remote = json.loads(data.decode("utf-8"))["files"]
+    # local manifest is kept, so only changed local files are hashed
+    if pullState["tree"] is None or pullState["tree"].root != setup["target"]:
+        os.makedirs(setup["target"], exist_ok=True)
+        pullState["tree"] = Manifest(setup["target"])
+    local = pullState["tree"]
+    local.refresh(force=True)
+    changed = [
+        path
+        for path, (_, _, digest) in remote.items()
+        if path not in local.entries or local.entries[path][2] != digest
+    ]
+    try:
+        if changed:
+            body = json.dumps({"files": changed}).encode("utf-8")
+            if setup["encode"]:
+                body = encryptBytes(body, setup["encode_key"])
+            batch = send(stats, connection, "POST", "/getFiles", data=body, stream=True)
+            with batch:
+                if batch.status_code != 200:
+                    raise FatalResponseCode(batch.status_code)
+                chunks = countChunks(batch.iter_content(setup["chunk_size"]), received)
+                if setup["encode"]:
+                    chunks = decryptChunks(chunks, setup["encode_key"])
+                if "X-Compression" in batch.headers:
+                    chunks = compression.decompressChunks(
+                        chunks, batch.headers["X-Compression"]
+                    )
+                receiveFiles(
+                    local, ChunkReader(chunks), setup["chunk_size"], setup["fsync"]
+                )
+        # only after batch was received, so failed pull leaves tree as it was
+        removeFiles(local, [path for path in local.entries if path not in remote])
+    finally:
+        stats.received(received[0])
+    pullState["manifest"] = response.headers.get("ETag")
+    return True
+
+
+class EncryptingReader:
+    """
+    File-like wrapper encrypting file while it is read,
+    lets requests stream upload with known length
+    """
+
+    def __init__(self, file, key: str = None) -> None:
+        """
+        Args:
+            file (file object): local file opened in binary mode
+            key (str, optional): encoding key, None to send raw bytes. Defaults to None.
+        """
+        self.file = file
+        self.key = key
+        self.offset = 0
+        # length is fixed when upload starts
+        self.length = os.fstat(file.fileno()).st_size
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.length - self.offset
+        chunk = self.file.read(remaining if size < 0 else min(size, remaining))
+        if self.key is not None:
+            chunk = encryptBytes(chunk, self.key, self.offset)
+        self.offset += len(chunk)
+        return chunk
+
+    def __len__(self) -> int:
+        return self.length
+
+
+def pushFile(setup, connection):
+    """Upload local file to server, replacing its target,
+    upload is refused (412) if server version differs
+    from last pulled one
+
+    Raises:
+        FatalResponseCode: If status code of request
+                            is not equal 200
+
+    Returns:
+        int: number of bytes sent
+    """
+    headers = {}
+    if pullState["etag"]:
+        headers["If-Match"] = pullState["etag"]
+    with open(setup["target"], "rb") as file:
+        reader = EncryptingReader(file, setup["encode_key"] if setup["encode"] else None)
+        response = connection.put("/putFile", data=reader, headers=headers)
+    if response.status_code != 200:
+        raise FatalResponseCode(response.status_code)
+    # uploaded version doesn't have to be pulled back
+    pullState["etag"] = response.headers.get("ETag")
+    return len(reader)
+
+
+def handshake(stats, setup, connection) -> dict:
+    """Initial test of connection with server, asks for
+    /connect and tests if it can be decoded
+
+    Raises:
+        FatalResponseCode: If status code of request is not equal 200
+        UnwantedConnectionError: If server refuses to talk with us
+        ValueError: If response can't be decoded, probably
+                    because of invalid key (json.JSONDecodeError
+                    and UnicodeDecodeError are ValueError)
+
+    Returns:
+        dict: decoded response, empty if encoding is off
+    """
+    response = send(stats, connection, "GET", "/connect")
+    if response.status_code != 200:
+        raise FatalResponseCode(response.status_code)
+    data = response.content
+    stats.received(len(data))
+    if not setup["encode"]:
+        return {}
+    data = json.loads(decryptBytes(data, setup["encode_key"]).decode("utf-8"))
+    if not data["success"]:
+        raise UnwantedConnectionError()
+    return data
+
+
+def pullerFor(setup) -> Daemon:
+    """Daemon used for pulling, pullTree for directories,
+    watchFile if long polling is enabled, pullFile otherwise
+    """
+    if setup["directory"]:
+        return pullTree
+    return watchFile if setup["watch"] else pullFile
+
+
+def preparePulling(setup) -> Daemon:
+    """Reset pulling state and intervals for new pulling session
+
+    Returns:
+        Daemon: daemon to start, see pullerFor()
+    """
+    # setup could have changed, so previous version tag is not valid
+    pullState["etag"] = None
+    pullState["manifest"] = None
+    POLLING.minimum = setup["min_interval"]
+    POLLING.maximum = setup["max_interval"]
+    POLLING.reset()
+    # long poll is re-armed at once, only failures are backed off
+    WATCHING.retry = setup["min_interval"]
+    WATCHING.maximum = setup["max_interval"]
+    WATCHING.reset()
+    pullFile.backoff = POLLING if setup["adaptive"] else None
+    pullTree.backoff = POLLING if setup["adaptive"] else None
+    watchFile.delay = 0
+    watchFile.backoff = WATCHING
+    # already imported by Connection
+    import requests
+
+    retry = RETRY + (
+        requests.ConnectionError,
+        requests.Timeout,
+        # connection dropped while body was streamed
+        requests.exceptions.ChunkedEncodingError,
+    )
+    for daemon in (pullFile, watchFile, pullTree):
+        daemon.retry = retry
+    return pullerFor(setup)
@@ -0,0 +1,138 @@
+# -*- encoding: utf-8 -*-
+from hashlib import blake2b
+from threading import Lock
+import os
+
+
+def fileDigest(path: str, chunkSize: int = 65536) -> bytes:
+    """Compute digest of file content, read in chunks
+
+    Args:
+        path (str): path to file
+        chunkSize (int, optional): size of single read. Defaults to 65536.
+
+    Returns:
+        bytes: digest
+    """
+    digest = blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunkSize), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def replaceFile(source: str, target: str, fsync: bool = False) -> None:
+    """Atomically rename source onto target, readers see
+    either old or new file, never partially written one
+
+    Args:
+        source (str): path to complete temporary file
+        target (str): path to replace
+        fsync (bool, optional): flush file and directory to disk
+                                before and after rename. Defaults to False.
+    """
+    if fsync:
+        with open(source, "rb+") as file:
+            os.fsync(file.fileno())
+    os.replace(source, target)
+    if fsync and os.name != "nt":
+        # make rename itself durable
+        fd = os.open(os.path.dirname(os.path.abspath(target)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class WriteTracker:
+    """
+    Remembers digest of content last written to each path,
+    so writing the same content again can be skipped
+    """
+
+    def __init__(self) -> None:
+        # path -> (digest, (inode, size, mtime_ns)) after last write
+        self._written = {}
+        self._lock = Lock()
+
+    def unchanged(self, path: str, digest: bytes) -> bool:
+        """Test if path still holds exactly what was last
+        written to it and that content has given digest
+
+        Args:
+            path (str): path to local file
+            digest (bytes): digest of new content
+
+        Returns:
+            bool: True if writing can be skipped
+        """
+        with self._lock:
+            record = self._written.get(path)
+        if record is None or record[0] != digest:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        # file could have been edited locally since
+        return record[1] == (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def commit(self, source: str, target: str, digest: bytes = None, fsync: bool = False) -> bool:
+        """Replace target with complete temporary file, unless
+        target already holds the same content, then temporary
+        file is removed
+
+        Args:
+            source (str): path to complete temporary file
+            target (str): path to replace
+            digest (bytes, optional): digest of source, computed if not given. Defaults to None.
+            fsync (bool, optional): flush to disk. Defaults to False.
+
+        Returns:
+            bool: True if target was written
+        """
+        digest = digest or fileDigest(source)
+        if self.unchanged(target, digest):
+            os.remove(source)
+            return False
+        replaceFile(source, target, fsync)
+        stat = os.stat(target)
+        with self._lock:
+            self._written[target] = (digest, (stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return True
+
+    def remove(self, path: str) -> bool:
+        """Remove file and forget what was written to it
+
+        Args:
+            path (str): path to local file
+
+        Returns:
+            bool: True if file existed
+        """
+        with self._lock:
+            self._written.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def write(self, path: str, data: bytes, fsync: bool = False) -> bool:
+        """Write data to path through temporary file, unless
+        path already holds the same content
+
+        Args:
+            path (str): path to local file
+            data (bytes): new content
+            fsync (bool, optional): flush to disk. Defaults to False.
+
+        Returns:
+            bool: True if file was written
+        """
+        digest = blake2b(data, digest_size=16).digest()
+        if self.unchanged(path, digest):
+            return False
+        with open(path + ".part", "wb") as file:
+            file.write(data)
+        return self.commit(path + ".part", path, digest, fsync)
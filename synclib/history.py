@@ -0,0 +1,403 @@
+# -*- encoding: utf-8 -*-
+from bisect import bisect_left
+from hashlib import blake2b
+from threading import Lock
+from typing import Iterator, List, Tuple
+import difflib
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from synclib.encryption import loadNumpy
+from synclib.files import replaceFile
+
+# bytes hashed by rolling hash to find chunk boundary
+WINDOW = 48
+# chunk size limits, boundaries are found on average every AVERAGE bytes
+MIN_CHUNK = 2048
+AVERAGE_CHUNK = 8192
+MAX_CHUNK = 65536
+# bytes of file hashed at once by numpy
+SCAN_BLOCK = 1048576
+# digest of chunk and of whole version
+DIGEST_SIZE = 16
+
+# chunk index record: digest, offset in pack, stored length, flags
+_CHUNK = struct.Struct(">16sQIB")
+# version index record: time, size, chunk count, digest, followed by chunk numbers
+_VERSION = struct.Struct(">dQI16s")
+_REF = struct.Struct(">I")
+# chunk flag, stored data is zlib compressed
+COMPRESSED = 1
+
+# random value of every byte, summed over window by rolling hash,
+# derived from fixed seed so boundaries never change
+TABLE = [
+    int.from_bytes(blake2b(bytes([value]), digest_size=4).digest(), "big")
+    for value in range(256)
+]
+
+
+def _candidates(data) -> List[int]:
+    """Find end offsets of windows whose hash has all
+    mask bits clear, each can end a chunk
+
+    Args:
+        data (bytes-like): content to scan
+
+    Returns:
+        list: ascending end offsets
+    """
+    mask = AVERAGE_CHUNK - 1
+    numpy = loadNumpy()
+    if numpy is None:
+        found = []
+        table = TABLE
+        view = memoryview(data)
+        value = 0
+        for index, byte in enumerate(view):
+            value = (value + table[byte]) & 0xFFFFFFFF
+            if index >= WINDOW:
+                value = (value - table[view[index - WINDOW]]) & 0xFFFFFFFF
+            if index + 1 >= WINDOW and not value & mask:
+                found.append(index + 1)
+        return found
+    table = numpy.array(TABLE, dtype=numpy.uint32)
+    array = numpy.frombuffer(data, dtype=numpy.uint8)
+    found = []
+    for base in range(0, len(array), SCAN_BLOCK):
+        low = max(0, base - WINDOW)
+        block = table[array[low : base + SCAN_BLOCK]]
+        # sums[k] is sum of first k values, uint32 wraps around
+        sums = numpy.zeros(len(block) + 1, dtype=numpy.uint32)
+        numpy.cumsum(block, dtype=numpy.uint32, out=sums[1:])
+        hashes = sums[WINDOW:] - sums[:-WINDOW]
+        # hashes[k] belongs to window ending at low + WINDOW + k
+        ends = numpy.flatnonzero((hashes & mask) == 0) + low + WINDOW
+        found.extend(ends[ends > base].tolist() if base else ends.tolist())
+    return found
+
+
+def chunkBoundaries(data) -> List[int]:
+    """Split content into chunks defined by content itself,
+    so insertion or removal changes only chunks around it
+
+    Args:
+        data (bytes-like): content to split
+
+    Returns:
+        list: end offset of every chunk, last one equals length of data
+    """
+    candidates = _candidates(data)
+    boundaries = []
+    start = 0
+    while start < len(data):
+        index = bisect_left(candidates, start + MIN_CHUNK)
+        end = min(start + MAX_CHUNK, len(data))
+        if index < len(candidates) and candidates[index] < end:
+            end = candidates[index]
+        boundaries.append(end)
+        start = end
+    return boundaries
+
+
+def chunkDigest(data) -> bytes:
+    return blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+class Version:
+    """Entry of history, chunks holds numbers of stored chunks"""
+
+    __slots__ = ("number", "time", "size", "digest", "chunks")
+
+    def __init__(self, number: int, stamp: float, size: int, digest: bytes, chunks: bytes):
+        self.number = number
+        self.time = stamp
+        self.size = size
+        self.digest = digest
+        self.chunks = chunks
+
+    def chunkNumbers(self) -> Tuple[int, ...]:
+        return struct.unpack(f">{len(self.chunks) // _REF.size}I", self.chunks)
+
+
+class History:
+    """
+    Store of file versions in directory, every version is split
+    with content defined chunking and each distinct chunk is kept
+    once in append only pack file, so version which differs by
+    small edit costs about size of the edit and its chunk list,
+    files are only appended and incomplete tail left by crash is
+    dropped when store is opened, store can have single writer
+    """
+
+    def __init__(self, directory: str, compress: bool = True, fsync: bool = False) -> None:
+        """Open store, directory is created if needed
+
+        Args:
+            directory (str): directory of store
+            compress (bool, optional): compress stored chunks. Defaults to True.
+            fsync (bool, optional): flush each version to disk. Defaults to False.
+        """
+        self.directory = directory
+        self.compress = compress
+        self.fsync = fsync
+        self.versions: List[Version] = []
+        # (offset, stored length, flags) of every chunk, by its number
+        self._chunks = []
+        self._numbers = {}
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load(self) -> None:
+        """Read indexes, incomplete records at their ends are truncated"""
+        packSize = 0
+        if os.path.exists(self._path("chunks.pack")):
+            packSize = os.path.getsize(self._path("chunks.pack"))
+        data = self._read("chunks.idx")
+        valid = 0
+        for position in range(0, len(data) - _CHUNK.size + 1, _CHUNK.size):
+            digest, offset, length, flags = _CHUNK.unpack_from(data, position)
+            if offset + length > packSize:
+                break
+            self._numbers[digest] = len(self._chunks)
+            self._chunks.append((offset, length, flags))
+            valid = position + _CHUNK.size
+        self._truncate("chunks.idx", len(data), valid)
+        data = self._read("versions.idx")
+        position = 0
+        while position + _VERSION.size <= len(data):
+            stamp, size, count, digest = _VERSION.unpack_from(data, position)
+            end = position + _VERSION.size + count * _REF.size
+            if end > len(data):
+                break
+            chunks = data[position + _VERSION.size : end]
+            version = Version(len(self.versions), stamp, size, digest, chunks)
+            if any(number >= len(self._chunks) for number in version.chunkNumbers()):
+                break
+            self.versions.append(version)
+            position = end
+        self._truncate("versions.idx", len(data), position)
+
+    def _read(self, name: str) -> bytes:
+        try:
+            with open(self._path(name), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return b""
+
+    def _truncate(self, name: str, length: int, valid: int) -> None:
+        if valid < length:
+            with open(self._path(name), "r+b") as file:
+                file.truncate(valid)
+
+    def _append(self, name: str, data: bytes) -> int:
+        """Append data to file of store
+
+        Returns:
+            int: offset data was written at
+        """
+        with open(self._path(name), "ab") as file:
+            offset = file.tell()
+            file.write(data)
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+        return offset
+
+    def record(self, data, stamp: float = None) -> Version:
+        """Add version with given content, nothing is stored if
+        content equals latest version
+
+        Args:
+            data (bytes-like): content of version
+            stamp (float, optional): time of version. Defaults to now.
+
+        Returns:
+            Version: stored or latest version
+        """
+        digest = chunkDigest(data)
+        with self._lock:
+            if self.versions and self.versions[-1].digest == digest:
+                return self.versions[-1]
+            view = memoryview(data)
+            numbers = []
+            pending = {}
+            # new chunks with their offsets relative to start of appended data
+            records = []
+            pack = []
+            packSize = 0
+            start = 0
+            for end in chunkBoundaries(data):
+                chunk = view[start:end]
+                start = end
+                key = chunkDigest(chunk)
+                number = self._numbers.get(key, pending.get(key))
+                if number is None:
+                    stored, flags = bytes(chunk), 0
+                    if self.compress:
+                        packed = zlib.compress(stored, 6)
+                        if len(packed) < len(stored):
+                            stored, flags = packed, COMPRESSED
+                    number = pending[key] = len(self._chunks) + len(records)
+                    records.append((key, packSize, len(stored), flags))
+                    pack.append(stored)
+                    packSize += len(stored)
+                numbers.append(number)
+            # chunks are written before index refers to them
+            base = self._append("chunks.pack", b"".join(pack)) if pack else 0
+            records = [(key, base + offset, size, flags) for key, offset, size, flags in records]
+            if records:
+                index = b"".join(_CHUNK.pack(*record) for record in records)
+                self._append("chunks.idx", index)
+            for key, offset, length, flags in records:
+                self._numbers[key] = len(self._chunks)
+                self._chunks.append((offset, length, flags))
+            chunks = struct.pack(f">{len(numbers)}I", *numbers)
+            stamp = time.time() if stamp is None else stamp
+            version = Version(len(self.versions), stamp, len(view), digest, chunks)
+            self._append(
+                "versions.idx",
+                _VERSION.pack(version.time, version.size, len(numbers), digest) + chunks,
+            )
+            self.versions.append(version)
+            return version
+
+    def recordFile(self, path: str, stamp: float = None) -> Version:
+        """Add current content of file as new version, file is read
+        into single buffer, not mapped, as it is edited by user and
+        truncating mapped file would kill client with SIGBUS
+
+        Args:
+            path (str): path to file
+            stamp (float, optional): time of version. Defaults to mtime of file.
+
+        Returns:
+            Version: stored or latest version
+        """
+        with open(path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            data = bytearray(stat.st_size)
+            view = memoryview(data)
+            length = 0
+            while length < len(data):
+                read = file.readinto(view[length:])
+                if not read:
+                    break
+                length += read
+            view.release()
+        # file truncated while reading, what was read is recorded
+        del data[length:]
+        return self.record(data, stat.st_mtime if stamp is None else stamp)
+
+    def iterChunks(self, number: int) -> Iterator[bytes]:
+        """Yield content of version chunk by chunk
+
+        Args:
+            number (int): version number, negative counts from latest
+
+        Raises:
+            IndexError: if there is no such version
+        """
+        version = self.versions[number]
+        with open(self._path("chunks.pack"), "rb") as pack:
+            for chunk in version.chunkNumbers():
+                offset, length, flags = self._chunks[chunk]
+                pack.seek(offset)
+                data = pack.read(length)
+                yield zlib.decompress(data) if flags & COMPRESSED else data
+
+    def read(self, number: int) -> bytes:
+        """Get content of version
+
+        Args:
+            number (int): version number, negative counts from latest
+
+        Raises:
+            IndexError: if there is no such version
+            ValueError: if content doesn't match stored digest
+        """
+        data = b"".join(self.iterChunks(number))
+        if chunkDigest(data) != self.versions[number].digest:
+            raise ValueError("Corrupted version.")
+        return data
+
+    def restore(self, number: int, path: str, fsync: bool = False) -> None:
+        """Replace file with content of version, through temporary file
+
+        Args:
+            number (int): version number, negative counts from latest
+            path (str): file to replace
+            fsync (bool, optional): flush to disk. Defaults to False.
+        """
+        data = self.read(number)
+        # own temporary name, path + ".part" is partial download of engine
+        fd, temporary = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), prefix=".", suffix=".restore"
+        )
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            replaceFile(temporary, path, fsync)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def diff(self, old: int, new: int, context: int = 3) -> Iterator[str]:
+        """Unified diff of two versions, content is decoded as utf-8,
+        versions made of the same chunks aren't read at all
+
+        Args:
+            old (int): number of older version
+            new (int): number of newer version
+            context (int, optional): lines of context. Defaults to 3.
+
+        Yields:
+            str: lines of diff
+        """
+        if self.versions[old].digest == self.versions[new].digest:
+            return None
+        before = self.read(old).decode("utf-8", "replace").splitlines(keepends=True)
+        after = self.read(new).decode("utf-8", "replace").splitlines(keepends=True)
+        yield from difflib.unified_diff(
+            before,
+            after,
+            f"version {self.versions[old].number}",
+            f"version {self.versions[new].number}",
+            n=context,
+        )
+
+    def storedSize(self) -> int:
+        """Get bytes taken by store on disk"""
+        return sum(
+            os.path.getsize(self._path(name))
+            for name in ("chunks.pack", "chunks.idx", "versions.idx")
+            if os.path.exists(self._path(name))
+        )
+
+
+if __name__ == "__main__":
+    # python -m synclib.history DIRECTORY [list | show N | diff A B | restore N PATH]
+    history = History(sys.argv[1])
+    command = sys.argv[2] if len(sys.argv) > 2 else "list"
+    if command == "list":
+        for version in history.versions:
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(version.time))
+            digest = version.digest.hex()
+            print(f"{version.number:6d}  {stamp}  {version.size:12d} B  {digest}")
+        logical = sum(version.size for version in history.versions)
+        print(f"{len(history.versions)} versions, {logical} B in {history.storedSize()} B")
+    elif command == "show":
+        sys.stdout.buffer.write(history.read(int(sys.argv[3])))
+    elif command == "diff":
+        sys.stdout.writelines(history.diff(int(sys.argv[3]), int(sys.argv[4])))
+    elif command == "restore":
+        history.restore(int(sys.argv[3]), sys.argv[4])
+    else:
+        sys.exit(f"Unknown command {command}")
@@ -0,0 +1,164 @@
+# -*- encoding: utf-8 -*-
+from hashlib import blake2b
+from threading import Lock
+import json
+import os
+import struct
+import time
+from typing import Dict, Iterable, Tuple
+
+# header of single file record in batched stream: path length and file size
+RECORD = struct.Struct(">HQ")
+
+
+def fileHash(path: str, chunkSize: int = 65536) -> str:
+    """Compute content hash of file, read in chunks
+
+    Args:
+        path (str): path to file
+        chunkSize (int, optional): size of single read. Defaults to 65536.
+
+    Returns:
+        str: hex digest
+    """
+    digest = blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunkSize), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Listing of files in directory tree with their size,
+    mtime and content hash, tree is walked at most once
+    per interval and only changed files are hashed again
+    """
+
+    def __init__(self, root: str, interval: float = 1.0) -> None:
+        """
+        Args:
+            root (str): path to directory
+            interval (float, optional): min seconds between walks. Defaults to 1.0.
+        """
+        self.root = root
+        self.interval = interval
+        self.version = None
+        # relative path -> (size, mtime_ns, hash)
+        self.entries: Dict[str, Tuple[int, int, str]] = {}
+        # relative path -> (inode, size, mtime_ns) of hashed file
+        self._identities = {}
+        self._scanned = None
+        self._lock = Lock()
+
+    def refresh(self, force: bool = False) -> str:
+        """Walk tree if last walk is older than interval
+        and update entries of changed files
+
+        Args:
+            force (bool, optional): walk regardless of interval. Defaults to False.
+
+        Returns:
+            str: manifest version, changes with any file
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._scanned is not None and now - self._scanned < self.interval:
+                return self.version
+            entries = {}
+            identities = {}
+            for relpath, path, stat in self._walk(self.root, ""):
+                identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                if self._identities.get(relpath) == identity:
+                    entries[relpath] = self.entries[relpath]
+                else:
+                    try:
+                        entries[relpath] = (stat.st_size, stat.st_mtime_ns, fileHash(path))
+                    except OSError:
+                        # file removed while walking
+                        continue
+                identities[relpath] = identity
+            if entries != self.entries or self.version is None:
+                self.entries = entries
+                digest = blake2b(json.dumps(entries, sort_keys=True).encode("utf-8"), digest_size=16)
+                self.version = f'"{digest.hexdigest()}"'
+            self._identities = identities
+            self._scanned = time.monotonic()
+            return self.version
+
+    def _walk(self, directory: str, prefix: str):
+        """Yield relative path, path and stat of each regular
+        file in directory tree, unfinished downloads and
+        uploads (*.part files) are skipped
+        """
+        try:
+            scanner = os.scandir(directory)
+        except OSError:
+            return None
+        with scanner:
+            for entry in scanner:
+                relpath = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._walk(entry.path, relpath + "/")
+                elif entry.is_file() and not entry.name.endswith(".part"):
+                    try:
+                        yield relpath, entry.path, entry.stat()
+                    except OSError:
+                        continue
+
+    def resolve(self, relpath: str) -> str:
+        """Turn relative path into path inside root
+
+        Args:
+            relpath (str): relative path with "/" separators
+
+        Raises:
+            ValueError: if path points outside of root
+
+        Returns:
+            str: path to file
+        """
+        parts = relpath.split("/")
+        if not relpath or relpath.startswith("/") or any(
+            part in ("", ".", "..") or os.sep in part or ":" in part for part in parts
+        ):
+            raise ValueError(f"Invalid path: {relpath!r}")
+        return os.path.join(self.root, *parts)
+
+    def toJson(self) -> bytes:
+        """Encode manifest as JSON
+
+        Returns:
+            bytes: JSON with version and files
+        """
+        with self._lock:
+            data = {"version": self.version, "files": self.entries}
+        return json.dumps(data).encode("utf-8")
+
+
+class ChunkReader:
+    """
+    Reads exact number of bytes from
+    iterable of byte chunks
+    """
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def read(self, size: int) -> bytes:
+        """Read size bytes, less only if stream ended
+
+        Args:
+            size (int): number of bytes to read
+
+        Returns:
+            bytes: read bytes
+        """
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        output, self._buffer = self._buffer[:size], self._buffer[size:]
+        return output
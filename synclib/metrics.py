@@ -0,0 +1,308 @@
+# -*- encoding: utf-8 -*-
+from bisect import bisect_left
+from threading import Lock, local
+from typing import Callable, Dict
+import time
+
+# upper bounds of request duration histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+
+class PathStats:
+    """Counters of requests to single path"""
+
+    __slots__ = (
+        "requests",
+        "seconds",
+        "buckets",
+        "bytesIn",
+        "bytesOut",
+        "encryption",
+        "statuses",
+        "hits",
+        "misses",
+    )
+
+    def __init__(self, buckets: int) -> None:
+        self.requests = 0
+        self.seconds = 0.0
+        # one more bucket for durations above last bound
+        self.buckets = [0] * (buckets + 1)
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.encryption = 0.0
+        self.statuses = {}
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, other: "PathStats") -> None:
+        """Add counters of other to this one"""
+        self.requests += other.requests
+        self.seconds += other.seconds
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+        self.bytesIn += other.bytesIn
+        self.bytesOut += other.bytesOut
+        self.encryption += other.encryption
+        for status, count in list(other.statuses.items()):
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.hits += other.hits
+        self.misses += other.misses
+
+
+class ObservedBody:
+    """
+    Response body passing chunks through, counts sent
+    bytes and records request when server closes it
+    """
+
+    def __init__(self, metrics: "Metrics", stats: PathStats, body, start: float, status: dict):
+        self.metrics = metrics
+        self.stats = stats
+        self.body = body
+        self.start = start
+        self.status = status
+        self.sent = 0
+
+    def __iter__(self):
+        iterator = iter(self.body)
+        while True:
+            # chunks can be produced on any thread, work done
+            # while producing them belongs to this request
+            self.metrics._local.current = self.stats
+            try:
+                chunk = next(iterator, None)
+            finally:
+                # body can be abandoned between chunks
+                self.metrics._local.current = None
+            if chunk is None:
+                return None
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.metrics._finish(self.stats, self.start, self.status, self.sent)
+
+
+class Metrics:
+    """
+    Request metrics by path, every thread updates its own
+    shard of counters, so requests never wait for a lock,
+    shards are summed when metrics are rendered
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        """
+        Args:
+            buckets (tuple, optional): upper bounds of duration histogram
+                                    buckets in seconds. Defaults to LATENCY_BUCKETS.
+        """
+        self.buckets = buckets
+        self._shards = []
+        self._lock = Lock()
+        self._local = local()
+
+    def _stats(self, path: str) -> PathStats:
+        """Get counters of path in shard of current thread"""
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        stats = shard.get(path)
+        if stats is None:
+            stats = shard[path] = PathStats(len(self.buckets))
+        return stats
+
+    def encryption(self, seconds: float) -> None:
+        """Add time spent encrypting or decrypting to request
+        handled by current thread, ignored outside of requests"""
+        stats = getattr(self._local, "current", None)
+        if stats is not None:
+            stats.encryption += seconds
+
+    def cacheLookup(self, hit: bool) -> None:
+        """Count payload cache lookup of request handled by
+        current thread, ignored outside of requests"""
+        stats = getattr(self._local, "current", None)
+        if stats is not None:
+            if hit:
+                stats.hits += 1
+            else:
+                stats.misses += 1
+
+    def observe(self, path: str, app: Callable, env: dict, response: Callable):
+        """Run WSGI application and record its request under path,
+        streamed bodies are recorded when server closes them
+
+        Args:
+            path (str): metrics label of request
+            app (callable): WSGI application
+            env (dict): request environment
+            response (callable): start_response of server
+
+        Returns:
+            iterable: response body
+        """
+        start = time.perf_counter()
+        stats = self._stats(path)
+        stats.bytesIn += int(env.get("CONTENT_LENGTH") or 0)
+        status = {}
+
+        def observed(line, headers, exc_info=None):
+            status["code"] = line.split()[0]
+            for name, value in headers:
+                if name.lower() == "content-length":
+                    status["length"] = int(value)
+            return response(line, headers, exc_info)
+
+        self._local.current = stats
+        try:
+            body = app(env, observed)
+        except BaseException:
+            status.setdefault("code", "500")
+            self._finish(stats, start, status, 0)
+            raise
+        finally:
+            # streamed body sets it again while producing chunks
+            self._local.current = None
+        if isinstance(body, (list, tuple)):
+            self._finish(stats, start, status, sum(len(chunk) for chunk in body))
+            return body
+        if "wsgi.file_wrapper" in env and isinstance(body, env["wsgi.file_wrapper"]):
+            # keep file wrapper, server sends it with sendfile
+            self._finish(stats, start, status, status.get("length", 0))
+            return body
+        return ObservedBody(self, stats, body, start, status)
+
+    def record(self, path: str, seconds: float, status: str, bytesIn: int = 0, bytesOut: int = 0):
+        """Record request handled outside of observe()"""
+        stats = self._stats(path)
+        stats.bytesIn += bytesIn
+        self._finish(stats, time.perf_counter() - seconds, {"code": status}, bytesOut)
+
+    def _finish(self, stats: PathStats, start: float, status: dict, sent: int) -> None:
+        seconds = time.perf_counter() - start
+        # shard can belong to other thread if body was closed elsewhere,
+        # updates are then racy, which is accepted to keep hot path lock free
+        stats.requests += 1
+        stats.seconds += seconds
+        stats.buckets[bisect_left(self.buckets, seconds)] += 1
+        stats.bytesOut += sent
+        code = status.get("code", "500")
+        stats.statuses[code] = stats.statuses.get(code, 0) + 1
+
+    def snapshot(self) -> Dict[str, PathStats]:
+        """Sum shards of all threads
+
+        Returns:
+            dict: path -> PathStats
+        """
+        with self._lock:
+            shards = list(self._shards)
+        total = {}
+        for shard in shards:
+            for path, stats in list(shard.items()):
+                if path not in total:
+                    total[path] = PathStats(len(self.buckets))
+                total[path].add(stats)
+        return total
+
+    def render(self, gauges: Dict[str, float] = None) -> bytes:
+        """Render metrics in Prometheus text exposition format
+
+        Args:
+            gauges (dict, optional): extra global values by metric name. Defaults to None.
+
+        Returns:
+            bytes: exposition text
+        """
+        total = self.snapshot()
+        paths = sorted(total)
+        lines = []
+
+        def family(name: str, kind: str, text: str, values):
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in values:
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+        family(
+            "synclib_requests_total",
+            "counter",
+            "Handled requests.",
+            ((f'path="{path}"', total[path].requests) for path in paths),
+        )
+        lines.append("# HELP synclib_request_duration_seconds Time spent handling request.")
+        lines.append("# TYPE synclib_request_duration_seconds histogram")
+        for path in paths:
+            stats = total[path]
+            count = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), stats.buckets):
+                count += bucket
+                lines.append(
+                    f'synclib_request_duration_seconds_bucket{{path="{path}",le="{bound}"}} {count}'
+                )
+            lines.append(f'synclib_request_duration_seconds_sum{{path="{path}"}} {stats.seconds}')
+            lines.append(f'synclib_request_duration_seconds_count{{path="{path}"}} {count}')
+        family(
+            "synclib_responses_total",
+            "counter",
+            "Responses by status code.",
+            (
+                (f'path="{path}",status="{status}"', count)
+                for path in paths
+                for status, count in sorted(total[path].statuses.items())
+            ),
+        )
+        family(
+            "synclib_request_bytes_total",
+            "counter",
+            "Received request body bytes.",
+            ((f'path="{path}"', total[path].bytesIn) for path in paths),
+        )
+        family(
+            "synclib_response_bytes_total",
+            "counter",
+            "Sent response body bytes.",
+            ((f'path="{path}"', total[path].bytesOut) for path in paths),
+        )
+        family(
+            "synclib_encryption_seconds_total",
+            "counter",
+            "Time spent encrypting and decrypting.",
+            ((f'path="{path}"', total[path].encryption) for path in paths),
+        )
+        family(
+            "synclib_cache_hits_total",
+            "counter",
+            "Payload cache hits.",
+            ((f'path="{path}"', total[path].hits) for path in paths),
+        )
+        family(
+            "synclib_cache_misses_total",
+            "counter",
+            "Payload cache misses.",
+            ((f'path="{path}"', total[path].misses) for path in paths),
+        )
+        family(
+            "synclib_cache_hit_ratio",
+            "gauge",
+            "Payload cache hit ratio.",
+            (
+                (f'path="{path}"', total[path].hits / (total[path].hits + total[path].misses))
+                for path in paths
+                if total[path].hits + total[path].misses
+            ),
+        )
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return ("\n".join(lines) + "\n").encode("utf-8")
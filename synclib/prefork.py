@@ -0,0 +1,104 @@
+# -*- encoding: utf-8 -*-
+from typing import Callable
+import logging
+import os
+import signal
+import socket
+import time
+
+# workers dying sooner than this after start are respawned with delay
+RESPAWN_DELAY = 1.0
+
+
+def forkWorker(run: Callable, sock: socket.socket, hangup) -> int:
+    """Fork worker process serving on inherited socket
+
+    Args:
+        run (callable): called with listening socket in worker
+        sock (socket.socket): listening socket
+        hangup: SIGHUP handler of worker
+
+    Returns:
+        int: pid of worker
+    """
+    # handlers of master mustn't run in worker before it sets its own
+    signals = {signal.SIGINT, signal.SIGTERM, signal.SIGHUP}
+    signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+    try:
+        pid = os.fork()
+    except BaseException:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+        raise
+    if pid:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+        return pid
+    code = 0
+    try:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, hangup)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+        run(sock)
+    except KeyboardInterrupt:
+        pass
+    except BaseException as e:
+        logging.exception(e, exc_info=True)
+        code = 1
+    finally:
+        # never return into code of master
+        os._exit(code)
+
+
+def serve(run: Callable, host: str = "0.0.0.0", port: int = 8080, workers: int = 0):
+    """Listen on host and port and serve with pool of forked worker
+    processes accepting connections from the same socket, dead
+    workers are replaced, SIGHUP is passed to all of them and
+    SIGINT or SIGTERM stops them
+
+    Args:
+        run (callable): called with listening socket in every worker,
+                        serves on it until process is terminated
+        host (str, optional): address to listen on. Defaults to "0.0.0.0".
+        port (int, optional): port to listen on. Defaults to 8080.
+        workers (int, optional): number of processes, 0 for one
+                                per CPU. Defaults to 0.
+    """
+    workers = workers or os.cpu_count() or 1
+    sock = socket.create_server((host, int(port)), backlog=1024)
+    hangup = signal.getsignal(signal.SIGHUP)
+    children = {}
+    stopping = []
+
+    def forward(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        forward(signal.SIGTERM, frame)
+
+    signal.signal(signal.SIGHUP, forward)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for _ in range(workers):
+            children[forkWorker(run, sock, hangup)] = time.monotonic()
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = children.pop(pid, None)
+            if started is None or stopping:
+                continue
+            logging.warning(f"Worker {pid} exited with status {status}, restarting.")
+            if time.monotonic() - started < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+                if stopping:
+                    continue
+            children[forkWorker(run, sock, hangup)] = time.monotonic()
+    finally:
+        sock.close()
@@ -0,0 +1,363 @@
+# -*- encoding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable
+import asyncio
+import logging
+import os
+import sys
+
+from synclib.encryption import decryptBytes, encryptBytes
+from synclib.files import WriteTracker
+import synclib.compression as compression
+import synclib.delta as delta
+
+
+class HTTPResponse:
+    """Status, headers (lowercase names) and body of response"""
+
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes) -> None:
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class HTTPConnection:
+    """
+    Minimal asyncio HTTP/1.1 client keeping single
+    keep-alive connection to one server, requests
+    sent through it are serialized
+    """
+
+    def __init__(self, address: str, port: str, timeout: float = 10.0) -> None:
+        """
+        Args:
+            address (str): server address
+            port (str): server port, empty for 80
+            timeout (float, optional): default request timeout in seconds. Defaults to 10.0.
+        """
+        self.address = address
+        self.port = int(port) if port else 80
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        headers: Dict[str, str] = None,
+        body: bytes = b"",
+        timeout: float = None,
+    ) -> HTTPResponse:
+        """Send request and read whole response, stale
+        keep-alive connection is reopened once
+
+        Args:
+            method (str): HTTP method
+            path (str): url path (with query) to resource
+            headers (dict, optional): request headers. Defaults to None.
+            body (bytes, optional): request body. Defaults to b"".
+            timeout (float, optional): timeout of this request. Defaults to self.timeout.
+
+        Raises:
+            ConnectionError: if server can't be reached or closes connection
+            asyncio.TimeoutError: if server doesn't respond in time
+
+        Returns:
+            HTTPResponse: server response
+        """
+        timeout = timeout or self.timeout
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.address}:{self.port}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        lines.append(f"Content-Length: {len(body)}")
+        message = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+        async with self._lock:
+            reused = self._writer is not None
+            try:
+                return await self._exchange(method, message, timeout)
+            except ConnectionError:
+                if not reused:
+                    raise
+            # server closed idle keep-alive connection, try once more
+            return await self._exchange(method, message, timeout)
+
+    async def _exchange(self, method: str, message: bytes, timeout: float) -> HTTPResponse:
+        try:
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.address, self.port), timeout
+                )
+            self._writer.write(message)
+            await self._writer.drain()
+            response = await asyncio.wait_for(self._readResponse(method), timeout)
+        except BaseException as e:
+            # unread part of failed response would be taken
+            # as response to next request, connection is dropped
+            self._abort()
+            if isinstance(e, asyncio.IncompleteReadError):
+                raise ConnectionError("Connection closed by server.") from e
+            if isinstance(e, asyncio.LimitOverrunError):
+                raise ValueError("Malformed response.") from e
+            raise
+        if response.headers.get("connection", "").lower() == "close":
+            await self.close()
+        return response
+
+    async def _readResponse(self, method: str) -> HTTPResponse:
+        reader = self._reader
+        parts = (await reader.readuntil(b"\r\n")).split(None, 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ValueError("Malformed status line.")
+        status = int(parts[1])
+        headers = {}
+        while True:
+            line = (await reader.readuntil(b"\r\n")).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if method == "HEAD" or status in (204, 304) or status < 200:
+            body = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if not size:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            # skip trailers
+            while (await reader.readuntil(b"\r\n")) != b"\r\n":
+                pass
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            headers["connection"] = "close"
+        return HTTPResponse(status, headers, body)
+
+    async def close(self) -> None:
+        """Close connection, next request opens new one"""
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        self._reader = self._writer = None
+
+    def _abort(self) -> None:
+        if self._writer is not None:
+            self._writer.transport.abort()
+        self._reader = self._writer = None
+
+
+class Source:
+    """
+    Single (server, target) pair followed by AsyncPuller,
+    configured by ClientCFG-like mapping
+    """
+
+    def __init__(self, setup, delay: float = 0.5) -> None:
+        """
+        Args:
+            setup (mapping): client configuration of this source
+            delay (float, optional): seconds between polls, also used
+                                    as retry delay after errors. Defaults to 0.5.
+        """
+        self.setup = setup
+        self.delay = delay
+        self.etag = None
+        self.watching = bool(setup["watch"])
+        self.received = 0
+        self.pulls = 0
+        self.errors = 0
+        self.lastError = None
+        self.connection = HTTPConnection(setup["address"], setup["port"], setup["timeout"])
+        self._signature = None
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        """Headers sent with every request of this source"""
+        if self.setup["compression"]:
+            return {"X-Accept-Compression": ", ".join(compression.METHODS)}
+        return {}
+
+    def decode(self, data: bytes, coding: str) -> bytes:
+        """Decrypt and decompress response body
+
+        Args:
+            data (bytes): response body
+            coding (str): compression method, None if not compressed
+
+        Returns:
+            bytes: payload
+        """
+        if self.setup["encode"]:
+            data = decryptBytes(data, self.setup["encode_key"])
+        if coding:
+            data = compression.decompress(data, coding)
+        return data
+
+    def signature(self) -> bytes:
+        """Block signature of local target, encrypted if
+        encoding is on, recomputed only if target changed
+        """
+        stat = os.stat(self.setup["target"])
+        identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if self._signature is None or self._signature[0] != identity:
+            with open(self.setup["target"], "rb") as file:
+                self._signature = (identity, delta.makeSignature(file.read()))
+        signature = self._signature[1]
+        if self.setup["encode"]:
+            signature = encryptBytes(signature, self.setup["encode_key"])
+        return signature
+
+    def patch(self, data: bytes, coding: str) -> bytes:
+        """Rebuild current file from local target and delta
+        response body, None if delta doesn't apply
+        """
+        with open(self.setup["target"], "rb") as file:
+            base = file.read()
+        try:
+            return delta.applyDelta(base, self.decode(data, coding))
+        except ValueError:
+            return None
+
+
+class AsyncPuller:
+    """
+    Follows many sources concurrently in single event loop,
+    decryption, delta and file writes run in shared thread
+    pool, so number of threads doesn't grow with sources
+    """
+
+    def __init__(self, sources: Iterable[Source], workers: int = 4) -> None:
+        """
+        Args:
+            sources (iterable): sources to follow
+            workers (int, optional): size of shared thread pool. Defaults to 4.
+        """
+        self.sources = list(sources)
+        self.executor = ThreadPoolExecutor(workers)
+        self.writes = WriteTracker()
+        self._stopped = None
+
+    async def run(self) -> None:
+        """Follow all sources until stop() is called"""
+        self._stopped = asyncio.Event()
+        try:
+            await asyncio.gather(*(self.follow(source) for source in self.sources))
+        finally:
+            for source in self.sources:
+                await source.connection.close()
+            self.executor.shutdown(wait=False)
+
+    def stop(self) -> None:
+        """Make run() return after current requests finish"""
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def follow(self, source: Source) -> None:
+        """Pull loop of single source, errors are logged and
+        counted and pulling is retried after source delay
+
+        Args:
+            source (Source): source to follow
+        """
+        while not self._stopped.is_set():
+            delay = source.delay
+            try:
+                await self.pull(source)
+                if source.watching and source.etag:
+                    # long poll is re-armed immediately
+                    delay = 0
+            except (OSError, ValueError, asyncio.TimeoutError) as e:
+                source.errors += 1
+                source.lastError = e
+                logging.warning(f"Pulling {source.setup['target']} failed: {e!r}")
+            except Exception as e:
+                # unexpected error mustn't stop other sources
+                source.errors += 1
+                source.lastError = e
+                logging.exception(e, exc_info=True)
+            try:
+                await asyncio.wait_for(self._stopped.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def pull(self, source: Source) -> bool:
+        """Pull single version of source target, waiting for
+        change on /watch first if long polling is enabled
+
+        Args:
+            source (Source): source to pull
+
+        Raises:
+            ValueError: if server responds with unexpected status
+
+        Returns:
+            bool: True if local target changed
+        """
+        setup = source.setup
+        loop = asyncio.get_running_loop()
+        headers = source.headers
+        exists = os.path.exists(setup["target"])
+        if exists and source.etag:
+            headers["If-None-Match"] = source.etag
+            if source.watching:
+                timeout = setup["watch_timeout"]
+                response = await source.connection.request(
+                    "GET", f"/watch?timeout={timeout}", headers, timeout=timeout + 10
+                )
+                if "etag" not in response.headers:
+                    # server doesn't support /watch, fall back to polling
+                    source.watching = False
+                elif response.status == 304:
+                    return False
+        data = None
+        if exists and setup["delta"]:
+            signature = await loop.run_in_executor(self.executor, source.signature)
+            response = await source.connection.request("POST", "/getDelta", headers, signature)
+            if response.status == 304:
+                return False
+            if response.status == 200:
+                source.received += len(response.body)
+                data = await loop.run_in_executor(
+                    self.executor,
+                    source.patch,
+                    response.body,
+                    response.headers.get("x-compression"),
+                )
+        if data is None:
+            response = await source.connection.request("GET", "/getFile", headers)
+            if response.status == 304:
+                return False
+            if response.status != 200:
+                raise ValueError(f"Unexpected response status: {response.status}")
+            source.received += len(response.body)
+            data = await loop.run_in_executor(
+                self.executor,
+                source.decode,
+                response.body,
+                response.headers.get("x-compression"),
+            )
+        written = await loop.run_in_executor(
+            self.executor, self.writes.write, setup["target"], data, setup["fsync"]
+        )
+        source.etag = response.headers.get("etag")
+        source.pulls += 1
+        return written
+
+
+if __name__ == "__main__":
+    # follow every client config given as argument
+    import synclib.config as config
+
+    puller = AsyncPuller(Source(config.ClientCFG(path)) for path in sys.argv[1:])
+    try:
+        asyncio.run(puller.run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,50 @@
+# -*- encoding: utf-8 -*-
+from threading import Lock
+
+
+class TransferStats:
+    """
+    Thread safe counters of pulling session, updated by
+    daemon threads and sampled periodically by UI, so
+    network code never waits for GUI
+    """
+
+    def __init__(self) -> None:
+        self.bytes = 0
+        self.requests = 0
+        self.errors = 0
+        # seconds until response headers of last timed request
+        self.latency = None
+        self._lock = Lock()
+
+    def received(self, size: int) -> None:
+        """Add number of received payload bytes"""
+        with self._lock:
+            self.bytes += size
+
+    def request(self, latency: float = None) -> None:
+        """Count finished request, latency is None
+        for requests which wait on purpose (long poll)"""
+        with self._lock:
+            self.requests += 1
+            if latency is not None:
+                self.latency = latency
+
+    def error(self) -> None:
+        """Count failed request"""
+        with self._lock:
+            self.errors += 1
+
+    def snapshot(self) -> dict:
+        """Get consistent copy of counters
+
+        Returns:
+            dict: bytes, requests, errors and latency
+        """
+        with self._lock:
+            return {
+                "bytes": self.bytes,
+                "requests": self.requests,
+                "errors": self.errors,
+                "latency": self.latency,
+            }
@@ -0,0 +1,189 @@
+# -*- encoding: utf-8 -*-
+from threading import Condition, Thread
+import asyncio
+import logging
+import time
+from typing import Callable, Hashable
+
+
+class Watcher:
+    """
+    Shared version poller, single thread checks
+    version of watched resource and wakes up all
+    requests waiting for it to change
+    """
+
+    def __init__(self, interval: float = 0.1) -> None:
+        """Create watcher, polling thread is started
+        with first waiter and ends with last one
+
+        Args:
+            interval (float, optional): seconds between version checks. Defaults to 0.1.
+        """
+        self.interval = interval
+        self.version = None
+        # start of probe which returned version, results of
+        # probes started earlier are outdated and ignored
+        self._probed = float("-inf")
+        self._probe = None
+        self._waiters = 0
+        self._thread = None
+        self._condition = Condition()
+
+    def wait(
+        self, probe: Callable[[], Hashable], version: Hashable, timeout: float
+    ) -> Hashable:
+        """Block until version returned by probe differs
+        from given one or until timeout expires
+
+        Args:
+            probe (callable): function returning current version
+            version (hashable): version just returned by probe to the caller
+            timeout (float): max seconds to wait
+
+        Returns:
+            hashable: current version, equal to given one on timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            # version of caller is newer than the one polled before,
+            # which could otherwise be returned as change right away
+            self._update(version, time.monotonic())
+            self._probe = probe
+            self._waiters += 1
+            if self._thread is None:
+                self._thread = Thread(target=self.__poll__, daemon=True)
+                self._thread.start()
+            try:
+                while self.version is None or self.version == version:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return version
+                    self._condition.wait(remaining)
+                return self.version
+            finally:
+                self._waiters -= 1
+
+    def _update(self, version: Hashable, started: float) -> None:
+        """Store version returned by probe started at given
+        time, condition must be held"""
+        if started < self._probed:
+            return None
+        self._probed = started
+        if version != self.version:
+            self.version = version
+            self._condition.notify_all()
+
+    def __poll__(self):
+        """Polling loop, ends when there are no waiters left"""
+        while True:
+            with self._condition:
+                if not self._waiters:
+                    # forget version, it will be outdated on next start
+                    self.version = None
+                    self._probed = float("-inf")
+                    self._thread = None
+                    return None
+                probe = self._probe
+            started = time.monotonic()
+            try:
+                version = probe()
+            except Exception as e:
+                logging.exception(e, exc_info=True)
+                version = None
+            with self._condition:
+                self._update(version, started)
+            time.sleep(self.interval)
+
+
+class AsyncWatcher:
+    """
+    asyncio counterpart of Watcher, waiting requests are
+    coroutines, so idle long polls don't hold threads,
+    single task runs probe (in executor) for all of them
+    """
+
+    def __init__(self, interval: float = 0.1) -> None:
+        """Create watcher, polling task is started
+        with first waiter and ends with last one
+
+        Args:
+            interval (float, optional): seconds between version checks. Defaults to 0.1.
+        """
+        self.interval = interval
+        self.version = None
+        # start of probe which returned version, results of
+        # probes started earlier are outdated and ignored
+        self._probed = float("-inf")
+        self._probe = None
+        self._executor = None
+        self._waiters = 0
+        self._task = None
+        # replaced by new event after every change
+        self._changed = None
+
+    async def wait(
+        self, probe: Callable[[], Hashable], version: Hashable, timeout: float, executor=None
+    ) -> Hashable:
+        """Wait until version returned by probe differs
+        from given one or until timeout expires
+
+        Args:
+            probe (callable): blocking function returning current version
+            version (hashable): version just returned by probe to the caller
+            timeout (float): max seconds to wait
+            executor (Executor, optional): executor running probe. Defaults to loop default.
+
+        Returns:
+            hashable: current version, equal to given one on timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self._probe = probe
+        self._executor = executor
+        self._waiters += 1
+        if self._task is None:
+            self._changed = asyncio.Event()
+            self._task = loop.create_task(self.__poll__())
+        # version of caller is newer than the one polled before,
+        # which could otherwise be returned as change right away
+        self._update(version, loop.time())
+        try:
+            while self.version is None or self.version == version:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return version
+                try:
+                    await asyncio.wait_for(self._changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            return self.version
+        finally:
+            self._waiters -= 1
+
+    def _update(self, version: Hashable, started: float) -> None:
+        """Store version returned by probe started at given time"""
+        if started < self._probed:
+            return None
+        self._probed = started
+        if version != self.version:
+            self.version = version
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+    async def __poll__(self):
+        """Polling loop, ends when there are no waiters left"""
+        loop = asyncio.get_running_loop()
+        while self._waiters:
+            started = loop.time()
+            try:
+                version = await loop.run_in_executor(self._executor, self._probe)
+            except Exception as e:
+                logging.exception(e, exc_info=True)
+                version = None
+            self._update(version, started)
+            await asyncio.sleep(self.interval)
+        # forget version, it will be outdated on next start
+        self.version = None
+        self._probed = float("-inf")
+        self._task = None